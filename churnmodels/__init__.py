@@ -1,6 +1,37 @@
-from .schema import models as schema
-from .helpers import *
-from .db import DBHelper
+import importlib
 
 # enter here the current release version
 __version__="0.0.9"
+
+# The attributes of the package are imported on first use (PEP 562): `import churnmodels` loads neither pandas nor
+# SQLAlchemy, they come with the first access to DBHelper, schema or one of the helpers.
+_lazy_attributes = {
+    "schema": ("churnmodels.schema.models", None),
+    "DBHelper": ("churnmodels.db", "DBHelper"),
+}
+_helpers = ["make_day_interval", "required_envvar", "progressBar_old", "progressBar", "days_between", "pretty_sql"]
+
+# the names of `from churnmodels import *`, the star import resolves them through __getattr__
+__all__ = list(_lazy_attributes) + _helpers
+
+
+def __getattr__(name):
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name in _lazy_attributes:
+        module_name, attribute = _lazy_attributes[name]
+        value = importlib.import_module(module_name)
+        if attribute is not None:
+            value = getattr(value, attribute)
+    else:
+        # the public names of helpers, formerly imported with *
+        helpers = importlib.import_module("churnmodels.helpers")
+        if name.startswith("_") or not hasattr(helpers, name):
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(helpers, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
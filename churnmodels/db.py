@@ -1,11 +1,78 @@
+import numpy as np
 import pandas as pd
 import sqlparse
-from sqlalchemy import create_engine, func, case, or_, literal, and_, select
+from sqlalchemy import create_engine, func, case, or_, literal, and_, select, text
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 from churnmodels.schema import get_schema_rfl, get_db_uri
 
 
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a statement (see DBHelper.explain), its bind parameters are processed like those of the statement.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement, analyze=False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    if compiler.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN ANALYZE " if element.analyze else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kw)
+
+
+def pivot_metrics(long_df, metric_names, dialect=None):
+    """
+    Pivots metrics in long form (see DBHelper.get_dataset_long) into the wide table of DBHelper.get_dataset: one row
+    per account_id, metric_time, observation_date and is_churn (ordered by observation_date and account_id), the
+    metric values scattered into a float matrix with one column per metric name.
+    :param long_df: DataFrame with account_id, metric_time, observation_date, is_churn, metric_name_id, metric_value
+    :param metric_names: DataFrame of the metric_name table (metric_name_id, metric_name), in the column order
+    :param dialect: the dialect name of the database, on "sqlite" the SUM of the ELSE 0 is an integer: a metric
+        column without any value is int64 there like in the SQL pivot (float64 on Postgres)
+    :return: DataFrame indexed by account_id and observation_date with is_churn and the metric columns
+    """
+    grouped = long_df.groupby(["observation_date", "account_id", "metric_time", "is_churn"], sort=True, dropna=False)
+    row = grouped.ngroup().to_numpy()
+    keys = grouped.size().index
+    n_rows = len(keys)
+
+    # metric name ids may repeat in metric_name, every one gets its column like in the CASE expressions
+    metric_ids, metric_column = np.unique(metric_names["metric_name_id"].to_numpy(), return_inverse=True)
+    position = pd.Index(metric_ids).get_indexer(long_df["metric_name_id"])
+    # the rows of unknown metric names count for the rows of the table, not for its columns
+    known = position >= 0
+    values = long_df["metric_value"].to_numpy(dtype=float)[known]
+    null = np.isnan(values)
+    cell = row[known] * len(metric_ids) + position[known]
+    shape = (n_rows, len(metric_ids))
+    # the bincount of no rows at all is an integer array
+    matrix = np.bincount(cell, weights=np.nan_to_num(values), minlength=n_rows * len(metric_ids)).astype(float)
+    matrix = matrix.reshape(shape)
+    # SUM skips NULL values, it is NULL if all rows of the group are NULL values of the metric
+    n_null = np.bincount(cell[null], minlength=n_rows * len(metric_ids)).reshape(shape)
+    matrix[n_null == np.bincount(row, minlength=n_rows)[:, None]] = np.nan
+
+    index = pd.MultiIndex.from_arrays([keys.get_level_values("account_id"), keys.get_level_values("observation_date")])
+    ddf = pd.DataFrame(matrix[:, metric_column], index=index)
+    if dialect == "sqlite":
+        has_value = np.bincount(position[known][~null], minlength=len(metric_ids)) > 0
+        integer = ~(has_value | np.isnan(matrix).any(axis=0))
+        for column in np.flatnonzero(integer[metric_column]):
+            ddf[column] = ddf[column].astype(np.int64)
+    ddf.columns = list(metric_names["metric_name"])
+    ddf.insert(0, "is_churn", keys.get_level_values("is_churn"))
+    return ddf
+
+
 class DBHelper():
     engine = None
     to_days = lambda x: x
@@ -59,10 +126,60 @@ class DBHelper():
         return text2
         # print(text2)
 
+    def explain(self, query, analyze=False):
+        """
+        The query plan of a query, to check which indexes it uses (see ensure_indexes): EXPLAIN QUERY PLAN on SQLite
+        (as tree like the sqlite3 shell prints it), EXPLAIN on Postgres.
+        :param query: query, select statement or SQL text
+        :param analyze: run the query and show the actual times and row counts (Postgres, EXPLAIN ANALYZE)
+        :return: the plan as text
+        """
+        statement = getattr(query, "statement", query)
+        if isinstance(statement, str):
+            statement = text(statement)
+        with self.engine.connect() as connection:
+            rows = connection.execute(Explain(statement, analyze)).fetchall()
+        if self.engine.dialect.name != "sqlite":
+            return "\n".join(row[0] for row in rows)
+        # rows of id, parent id, unused, detail, the parents come first
+        depth = {0: -1}
+        lines = []
+        for node_id, parent_id, _, detail in rows:
+            depth[node_id] = depth.get(parent_id, -1) + 1
+            lines.append("  " * depth[node_id] + detail)
+        return "\n".join(lines)
+
     def get_session(self):
         return self.session
 
-    def get_dataset(self, d_obs_start=None, d_obs_end=None, metric_period=7):
+    def get_dataset(self, d_obs_start=None, d_obs_end=None, metric_period=7, pivot="sql"):
+        """
+        The metrics of the observations, one column per metric name, indexed by account_id and observation_date.
+        :param pivot: "sql" sums one CASE per metric name in the query, "numpy" fetches the metrics in long form
+            (see get_dataset_long) and pivots them with pivot_metrics, the result is the same
+        """
+        if pivot == "numpy":
+            metric_names = pd.read_sql(self.get_session().query(self.T.MetricName).statement, self.engine)
+            return pivot_metrics(self.get_dataset_long(d_obs_start, d_obs_end, metric_period), metric_names,
+                                 self.engine.dialect.name)
+        if pivot != "sql":
+            raise ValueError(f"unknown pivot {pivot}, use sql or numpy")
+        Metric = self.T.Metric
+        Observation = self.T.Observation
+        qr = self.dataset_query(d_obs_start, d_obs_end, metric_period) \
+            .order_by(Observation.observation_date, Metric.account_id)
+
+        # print(pretty_sql(qr))
+        ddf = pd.read_sql(qr.statement, self.engine)
+        # ddf=ddf.set_index("account_id")
+        ddf = ddf.set_index(["account_id", "observation_date"])
+        return ddf
+
+    def dataset_query(self, d_obs_start=None, d_obs_end=None, metric_period=7):
+        """
+        The query of get_dataset, not ordered.
+        :return: query with account_id, observation_date, is_churn and a column per metric name
+        """
         Metric = self.T.Metric
         MetricName = self.T.MetricName
         Observation = self.T.Observation
@@ -86,21 +203,57 @@ class DBHelper():
             Metric.metric_time > func.DATE(self.to_days(Observation.observation_date) - metric_period),
             Metric.metric_time <= Observation.observation_date) \
             .group_by(Metric.account_id, Metric.metric_time,
-                      Observation.observation_date, Observation.is_churn) \
-            .order_by(Observation.observation_date, Metric.account_id)
+                      Observation.observation_date, Observation.is_churn)
+
+        if d_obs_start is not None:
+            qr = qr.filter(Observation.observation_date >= d_obs_start)
+        if d_obs_end is not None:
+            qr = qr.filter(Observation.observation_date <= d_obs_end)
+
+        return qr
+
+    def get_dataset_long(self, d_obs_start=None, d_obs_end=None, metric_period=7):
+        """
+        The metrics of the observations in long form, one row per metric row: the same join as get_dataset without
+        CASE expressions and grouping, so the query does not grow with the number of metric names.
+        :return: DataFrame with account_id, metric_time, observation_date, is_churn, metric_name_id, metric_value
+        """
+        Metric = self.T.Metric
+        Observation = self.T.Observation
+        session = self.get_session()
+        qr = session.query(
+            Metric.account_id,
+            Metric.metric_time,
+            Observation.observation_date,
+            Observation.is_churn,
+            Metric.metric_name_id,
+            Metric.metric_value
+        ) \
+            .join(Observation, Metric.account_id == Observation.account_id) \
+            .filter(
+            Metric.metric_time > func.DATE(self.to_days(Observation.observation_date) - metric_period),
+            Metric.metric_time <= Observation.observation_date)
 
         if d_obs_start is not None:
             qr = qr.filter(Observation.observation_date >= d_obs_start)
         if d_obs_end is not None:
             qr = qr.filter(Observation.observation_date <= d_obs_end)
 
+        return pd.read_sql(qr.statement, self.engine)
+
+    def get_active_customers(self):
+        Metric = self.T.Metric
+        qr = self.active_customers_query().order_by(Metric.account_id)
+
         # print(pretty_sql(qr))
         ddf = pd.read_sql(qr.statement, self.engine)
-        # ddf=ddf.set_index("account_id")
-        ddf = ddf.set_index(["account_id", "observation_date"])
         return ddf
 
-    def get_active_customers(self):
+    def active_customers_query(self):
+        """
+        The query of get_active_customers, not ordered.
+        :return: query with account_id, last_metric_time and a column per metric name
+        """
         Metric = self.T.Metric
         MetricName = self.T.MetricName
         Subscription = self.T.Subscription
@@ -129,12 +282,96 @@ class DBHelper():
             func.DATE(Subscription.start_date) <= last_metric_time,
             or_(func.DATE(Subscription.end_date) >= last_metric_time, Subscription.end_date == None)
         ) \
-            .group_by(Metric.account_id, "last_metric_time") \
-            .order_by(Metric.account_id)
+            .group_by(Metric.account_id, "last_metric_time")
+        return qr
 
-        # print(pretty_sql(qr))
-        ddf = pd.read_sql(qr.statement, engine)
-        return ddf
+    def iter_dataset(self, d_obs_start=None, d_obs_end=None, metric_period=7, partition="observation_date",
+                     accounts=100000, chunksize=10000):
+        """
+        get_dataset in parts, for datasets that do not fit into memory: the rows are streamed from the database in
+        chunks of chunksize rows and yielded as DataFrames with the columns, index and dtypes of get_dataset (see
+        read_partitions). By observation date the parts concatenated are get_dataset; by account id they have the
+        rows of get_dataset in another order (each part is ordered by observation date, the parts by account id),
+        sort_index(level="observation_date", sort_remaining=False, kind="stable") gives get_dataset.
+        :param partition: "observation_date" yields the rows of one observation date per DataFrame (ordered like
+            get_dataset), "account_id" the rows of a range of account ids per DataFrame
+        :param accounts: number of account ids in a range
+        :param chunksize: number of rows fetched at once
+        :return: generator of DataFrames
+        """
+        Metric = self.T.Metric
+        Observation = self.T.Observation
+        qr = self.dataset_query(d_obs_start, d_obs_end, metric_period)
+        if partition == "observation_date":
+            qr = qr.order_by(Observation.observation_date, Metric.account_id)
+            part_key = lambda ddf: ddf["observation_date"]
+        elif partition == "account_id":
+            qr = qr.order_by(Metric.account_id, Observation.observation_date)
+            part_key = lambda ddf: ddf["account_id"] // accounts
+        else:
+            raise ValueError(f"unknown partition {partition}, use observation_date or account_id")
+        metric_names = pd.read_sql(self.get_session().query(self.T.MetricName.metric_name).statement, self.engine)
+        for ddf in self.read_partitions(qr, part_key, metric_names["metric_name"], chunksize):
+            if partition == "account_id":
+                ddf = ddf.sort_values(["observation_date", "account_id"], kind="stable")
+            yield ddf.set_index(["account_id", "observation_date"])
+
+    def iter_active_customers(self, accounts=100000, chunksize=10000):
+        """
+        get_active_customers in parts: the rows are streamed from the database in chunks of chunksize rows and
+        yielded as DataFrames with the rows of a range of account ids, concatenated they give get_active_customers
+        (the dtypes too, see read_partitions).
+        :param accounts: number of account ids in a range
+        :param chunksize: number of rows fetched at once
+        :return: generator of DataFrames
+        """
+        Metric = self.T.Metric
+        qr = self.active_customers_query().order_by(Metric.account_id)
+        metric_names = pd.read_sql(self.get_session().query(self.T.MetricName.metric_name).statement, self.engine)
+        return self.read_partitions(qr, lambda ddf: ddf["account_id"] // accounts, metric_names["metric_name"],
+                                    chunksize)
+
+    def read_partitions(self, qr, part_key, value_columns, chunksize=10000):
+        """
+        Streams the rows of a query, on Postgres with a server-side cursor (stream_results), on SQLite with
+        fetchmany, and yields them in parts: the rows with the same part_key, the query must be ordered by it. The
+        rows are numbered on from part to part and the value columns keep the dtype the database gives them, so
+        the parts concatenated are the eager result (a column of a part is only float if the eager one is).
+        :param qr: query
+        :param part_key: function DataFrame -> Series of the partition keys of the rows
+        :param value_columns: the names of the metric columns (the SUM columns)
+        :param chunksize: number of rows fetched at once
+        :return: generator of DataFrames
+        """
+        value_columns = set(value_columns)
+        n_rows = 0
+        with self.engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            # the chunks of the last part, it may continue in the next chunk
+            pending, pending_key = [], None
+            for chunk in pd.read_sql(qr.statement, connection, chunksize=chunksize):
+                if chunk.empty:
+                    continue
+                # a value column of NULLs only would be object, in the eager result they are NaN of a float column
+                chunk = chunk.astype({column: float for column, dtype in chunk.dtypes.items()
+                                      if column in value_columns and dtype == object})
+                keys = part_key(chunk)
+                last_key = keys.iloc[-1]
+                if pending and last_key == pending_key and (keys == last_key).all():
+                    pending.append(chunk)
+                    continue
+                ddf = pd.concat(pending + [chunk], ignore_index=True)
+                keys = part_key(ddf)
+                complete = (keys != last_key).to_numpy()
+                for _, part in ddf[complete].groupby(keys[complete], sort=False):
+                    part.index = pd.RangeIndex(n_rows, n_rows + len(part))
+                    n_rows += len(part)
+                    yield part
+                pending, pending_key = [ddf[~complete]], last_key
+            if pending:
+                part = pd.concat(pending, ignore_index=True)
+                part.index = pd.RangeIndex(n_rows, n_rows + len(part))
+                yield part
 
     def make_relative_metrics(self, d_obs_start, d_obs_end, metric_name1, metric_name2):
         num_metric = self.make_relative_metrics_part(d_obs_start, d_obs_end, "num_metric", "num_value",
@@ -188,6 +425,69 @@ class DBHelper():
             .cte(cte_name)
         return num_metric
 
+    def event_count_metrics(self, d_start_date, d_end_date, window_days=28, step=7):
+        """
+        Multi date event counts (§3.5) from the daily event counts in event_daily: the number of events of each
+        account and event type in windows of window_days days, with a window ending every step days from d_start_date
+        to d_end_date. The metric_name is the event type name with "_per_month" like the metrics counted from event.
+        :return: query with account_id, event_type_id, metric_name, metric_value, metric_time
+        """
+        EventDaily = self.T.EventDaily
+        EventType = self.T.EventType
+        session = self.get_session()
+        subq_days = self.days_interval(func.DATE(self.to_days(d_start_date) - window_days),
+                                       func.DATE(self.to_days(d_end_date) - window_days), step, "date").subquery()
+        days_vec = session.query(
+            subq_days.c.date.label("start_date"),
+            func.DATE(self.to_days(subq_days.c.date) + window_days).label("end_date")
+        ).cte("days_vec")
+        qr = session.query(
+            EventDaily.account_id,
+            EventType.event_type_id,
+            (EventType.event_type_name + literal("_per_month")).label("metric_name"),
+            func.sum(EventDaily.n).label("metric_value"),
+            days_vec.c.end_date.label("metric_time")
+        ) \
+            .join(days_vec, and_(EventDaily.day >= days_vec.c.start_date, EventDaily.day < days_vec.c.end_date)) \
+            .join(EventType, EventDaily.event_type_id == EventType.event_type_id) \
+            .group_by(EventDaily.account_id, EventType.event_type_id, EventType.event_type_name, "metric_time") \
+            .order_by(EventDaily.account_id, EventType.event_type_id, "metric_time")
+        return qr
+
+    def events_per_day(self, d_start_date, d_end_date):
+        """
+        The number of events per event type and day from the daily event counts in event_daily.
+        :return: query with event_type_name, event_date, n_event
+        """
+        EventDaily = self.T.EventDaily
+        EventType = self.T.EventType
+        session = self.get_session()
+        qr = session.query(
+            EventType.event_type_name,
+            EventDaily.day.label("event_date"),
+            func.sum(EventDaily.n).label("n_event")
+        ) \
+            .join(EventType, EventType.event_type_id == EventDaily.event_type_id) \
+            .filter(EventDaily.day.between(d_start_date, d_end_date)) \
+            .group_by(EventType.event_type_name, EventDaily.event_type_id, EventDaily.day) \
+            .order_by(EventDaily.event_type_id, EventDaily.day)
+        return qr
+
+    def insert_event_count_metrics(self, d_start_date, d_end_date, window_days=28, step=7):
+        """
+        Inserts the event_count_metrics into the metric table, the metric names must exist in metric_name.
+        """
+        Metric = self.T.Metric
+        MetricName = self.T.MetricName
+        session = self.get_session()
+        counts = self.event_count_metrics(d_start_date, d_end_date, window_days, step).subquery()
+        select_stm = select([counts.c.account_id, counts.c.metric_time, MetricName.metric_name_id,
+                             counts.c.metric_value]) \
+            .select_from(counts.join(MetricName, MetricName.metric_name == counts.c.metric_name))
+        target_columns = ['account_id', 'metric_time', 'metric_name_id', 'metric_value']
+        session.execute(Metric.__table__.insert().from_select(target_columns, select_stm))
+        session.commit()
+
     def days_interval(self, d_start_date, d_end_date, step=7, label="date"):
         session = self.get_session()
         cnt = session.query(func.DATE(d_start_date).label(label)) \
@@ -196,7 +496,7 @@ class DBHelper():
         end_crit = next_date <= d_end_date
         if step < 0:
             end_crit = next_date >= d_end_date
-        union_all = cnt.union_all(select([next_date], cnt).where(end_crit))
+        union_all = cnt.union_all(select([next_date]).select_from(cnt).where(end_crit))
         return session.query(union_all)
 
     def add_metrics(self, newmetricname, fields):
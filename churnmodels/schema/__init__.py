@@ -1,3 +1,2 @@
 from .models import *
-from .model_rfl import _howto_do_it as reflect_db
 from .model_rfl import get_schema_rfl, get_db_uri
@@ -1,13 +1,14 @@
-from sqlalchemy import MetaData, create_engine, Table
+from sqlalchemy import MetaData, create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from re import sub
-import tempfile
-import sys
-import os
-import shutil
+import hashlib
+import types
 
 Base = declarative_base()
 
+# the schema modules built by this process, by database uri and schema, with the DDL fingerprint they were built for
+_schema_modules = {}
+
 
 # function to convert string to camelCase
 def camelCase(string):
@@ -40,93 +41,71 @@ def get_db_uri(options, dialect="sqlite"):
 
 def get_schema_rfl(options):
     """
-    return the dynamical loaded schema module cotaining wrapper classes of the DB tables
+    return the schema module containing mapped classes of the DB tables (Account, Subscription, ...)
+    The classes are built in memory from the reflected MetaData, the module of a database is kept for the process
+    (with its engine) and built again only when the DDL fingerprint changes. The cache is not persisted: every new
+    process reflects the database once, a cached MetaData would have to be unpickled from a file.
     :param options:
-        dict containing user, pass, dbname, schema, host, port
+        dict containing dialect, file (sqlite) or user, pass, dbname, schema, host, port (postgres)
     :type options:
     :return:
     :rtype:
     """
-    module = None
-    tmp = tempfile.NamedTemporaryFile(mode="w+t", delete=False, suffix=".py")
     dialect = get_or_default(options, "dialect", "sqlite")
-
     if dialect in ["postgres", "postgresql"]:
-        text = _howto_do_it(options)
+        database_uri = get_db_uri(options, "postgresql")
+        schema = get_or_default(options, "schema", "biznet1")
     else:
-        sqlitefile = get_or_default(options, "file", ":memory:")
-        text = _howto_do_it_def(sqlitefile)
-
-    somedir = os.path.dirname(tmp.name)
-    module_name = os.path.basename(tmp.name)[:-3]
-    hold_path = sys.path
-    sys.path.insert(1, somedir)
-    try:
-        tmp.write(text)
-        tmp.flush()
-        module = __import__(module_name)
-        # for key, val in module.__dict__.items():
-        #     print(key)
-    finally:
-        tmp.close()  # deletes the file
-        try:
-            os.remove(tmp.name)
-            # we protect the user: some py files could contain user password informations
-            shutil.rmtree(f"{somedir}/__pycache__")
-        except:
-            pass
-
-    sys.path = hold_path
-    return module
-
-
-
-def _howto_do_it_def(sqlitefile):
-
-    database_uri = f"sqlite:///{sqlitefile}"
-    engine = create_engine(database_uri)
+        database_uri = get_db_uri(options, "sqlite")
+        schema = None
 
-    meta = MetaData()
-    meta.reflect(bind=engine)
-    database_uri=f"\ndatabase_uri = \"sqlite:///{sqlitefile}\""
-    return _create_py_script(meta, database_uri)
+    key = (database_uri, schema)
+    cached = _schema_modules.get(key)
+    engine = cached[1].engine if cached is not None else create_engine(database_uri)
+    fingerprint = ddl_fingerprint(engine, schema)
+    if cached is None or cached[0] != fingerprint:
+        meta = MetaData()
+        meta.reflect(bind=engine, schema=schema)
+        _schema_modules[key] = (fingerprint, _create_module(meta, engine, database_uri, schema))
+    return _schema_modules[key][1]
 
-def _howto_do_it(options):
-    user = get_or_default(options, "user", "postgres")
-    pw = get_or_default(options, "pass", "password")
-    dbname = get_or_default(options, "dbname", "churn")
-    schema = get_or_default(options, "schema", "biznet1")
-    host = get_or_default(options, "host", "localhost")
-    port = get_or_default(options, "port", "5432")
 
-    database_uri = f"postgresql://{user}:{pw}@{host}:{port}/{dbname}"
-    engine = create_engine(database_uri)
-
-    meta = MetaData()
-    meta.reflect(bind=engine, schema=schema)
-    database_uri2=f"\ndatabase_uri = \"postgresql://{user}:{pw}@{host}:{port}/{dbname}\""
-    return _create_py_script(meta, database_uri2, schema)
-
-
-def _create_py_script(meta, database_uri, schema=None):
-    start_text = ""
-    start_text += f"\nfrom sqlalchemy import MetaData, create_engine, Table"
-    start_text += f"\nfrom sqlalchemy.ext.declarative import declarative_base"
-    start_text += database_uri
-    start_text += f"\nengine = create_engine(database_uri)"
-    start_text += f"\nBase = declarative_base(bind=engine)"
-    if schema is not None:
-        start_text += f"\nBase.metadata.schema = '{schema}'"
-    # start_text += f"\nprint(Base.__dict__)"
+def ddl_fingerprint(engine, schema=None):
+    """
+    A digest of the table definitions, from one query on the catalog instead of a reflection: the sql of the
+    sqlite_master entries, or the columns and key constraints in the information_schema of the Postgres schema.
+    :return: hex digest
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name == "sqlite":
+            rows = connection.exec_driver_sql(
+                "SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name").fetchall()
+        else:
+            rows = connection.execute(text(
+                "SELECT table_name, column_name, data_type, is_nullable, column_default "
+                "FROM information_schema.columns WHERE table_schema = :schema "
+                "ORDER BY table_name, ordinal_position"), {"schema": schema}).fetchall()
+            rows += connection.execute(text(
+                "SELECT tc.table_name, tc.constraint_type, kcu.column_name "
+                "FROM information_schema.table_constraints tc JOIN information_schema.key_column_usage kcu "
+                "ON tc.constraint_schema = kcu.constraint_schema AND tc.constraint_name = kcu.constraint_name "
+                "WHERE tc.table_schema = :schema ORDER BY 1, 2, 3"), {"schema": schema}).fetchall()
+    return hashlib.sha1(repr([tuple(row) for row in rows]).encode()).hexdigest()
+
+
+def _create_module(meta, engine, database_uri, schema=None):
+    """
+    The schema module: a mapped class (named in camelCase) for every reflected table with a primary key, and
+    database_uri, engine and Base like the generated modules had.
+    """
+    module = types.ModuleType("churnmodels.schema.reflected")
+    module.database_uri = database_uri
+    module.engine = engine
+    module.Base = declarative_base(bind=engine, metadata=meta)
     for table in meta.tables.values():
-        tblname = table.name
-        tblname = tblname.split(".")[-1]
-        classname = camelCase(tblname)
-        new_table_class = f"class {classname}(Base):"
-        new_table_class += f"\n\t__table__ = Table('{table.name}', Base.metadata, autoload=True)"
-        # new_table_class += f"\n\t__table_args__ = {{'schema': '{schema}', 'autoload': True}}"
-        start_text += f"\n\n{new_table_class}"
-    start_text += "\n"
-    # print(start_text)
-    # exec(start_text)
-    return start_text
+        if len(table.primary_key.columns) == 0:
+            # declarative can not map a table without primary key
+            continue
+        classname = camelCase(table.name.split(".")[-1])
+        setattr(module, classname, type(classname, (module.Base,), {"__table__": table}))
+    return module
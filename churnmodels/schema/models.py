@@ -1,6 +1,6 @@
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, event
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, event, inspect, text
 import pandas as pd
 import os
 
@@ -75,6 +75,30 @@ class Event(Base):
             self.account_id, self.event_time, self.event_type_id)
 
 
+class EventDaily(Base):
+    __tablename__ = "event_daily"
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    event_type_id = Column(Integer, nullable=False)
+    n = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<EventDaily(account_id='%s', day='%s', event_type_id='%s', n='%s')>" % (
+            self.account_id, self.day, self.event_type_id, self.n)
+
+
+class IdSequence(Base):
+    __tablename__ = "id_sequence"
+
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<IdSequence(name='%s', next_id='%s')>" % (self.name, self.next_id)
+
+
 class EventType(Base):
     __tablename__ = "event_type"
 
@@ -161,6 +185,106 @@ def create_tables(engine):
     metadata.create_all()
 
 
+# the secondary indexes of the queries on the churn tables: name -> (table, key columns, covered columns)
+INDEXES = {
+    "ix_metric_account_time_name": ("metric", ("account_id", "metric_time", "metric_name_id"), ("metric_value",)),
+    "ix_event_time_account_type": ("event", ("event_time", "account_id", "event_type_id"), ()),
+    "ix_event_daily_day_account_type": ("event_daily", ("day", "account_id", "event_type_id"), ("n",)),
+    "ix_subscription_account_dates": ("subscription", ("account_id", "start_date", "end_date"), ()),
+    "ix_observation_account_date": ("observation", ("account_id", "observation_date"), ()),
+}
+# indexes only one dialect gets: the expression index for the DATE(metric_time) filter of get_active_customers
+DIALECT_INDEXES = {
+    "postgresql": {
+        "ix_metric_day": ("metric", ("(DATE(metric_time))",), ()),
+    },
+}
+
+
+def _index_schema(engine, schema):
+    # the models live in the schema of CHURN_DB_SCHEMA on Postgres
+    if schema is None and engine.dialect.name != "sqlite":
+        return Base.metadata.schema
+    return schema
+
+
+def index_statements(engine, tables=None, schema=None):
+    """
+    The CREATE INDEX statements of the churn indexes for the dialect of the engine. The covered columns are an
+    INCLUDE of the index in Postgres and trailing key columns in SQLite, so the metric values are read from the
+    index only.
+    :param engine: db engine object
+    :param tables: names of the tables, None for all tables with indexes
+    :param schema: schema of the tables (Postgres), None for the schema of the models
+    :return: dict index name -> (table name, statement)
+    """
+    dialect = engine.dialect.name
+    schema = _index_schema(engine, schema)
+    prefix = f"{schema}." if schema else ""
+    statements = {}
+    for name, (table, columns, covered) in {**INDEXES, **DIALECT_INDEXES.get(dialect, {})}.items():
+        if tables is not None and table not in tables:
+            continue
+        if dialect == "postgresql":
+            include = f" INCLUDE ({', '.join(covered)})" if covered else ""
+            sql = f"CREATE INDEX IF NOT EXISTS {name} ON {prefix}{table} ({', '.join(columns)}){include}"
+        else:
+            sql = f"CREATE INDEX IF NOT EXISTS {prefix}{name} ON {table} ({', '.join(columns + covered)})"
+        statements[name] = (table, sql)
+    return statements
+
+
+def ensure_indexes(engine, tables=None, schema=None, analyze=True):
+    """
+    Creates the churn indexes (see INDEXES) that do not exist yet, on the tables that exist. After bulk loads
+    building the indexes at once is much faster than updating them row by row (see bulk_load of the simulation
+    writer).
+    :param engine: db engine object
+    :param tables: names of the tables, None for all tables with indexes
+    :param schema: schema of the tables (Postgres), None for the schema of the models
+    :param analyze: ANALYZE the tables with new indexes, so the query planner knows their statistics
+    :return: names of the created indexes
+    """
+    statements = index_statements(engine, tables, schema)
+    schema = _index_schema(engine, schema)
+    inspector = inspect(engine)
+    existing_tables = {table for table, sql in statements.values() if inspector.has_table(table, schema=schema)}
+    with engine.begin() as connection:
+        # the inspector does not reflect expression indexes
+        if engine.dialect.name == "sqlite":
+            rows = connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")
+        else:
+            rows = connection.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = :schema"),
+                                      {"schema": schema or "public"})
+        existing = {row[0] for row in rows}
+        created = [name for name, (table, sql) in statements.items()
+                   if table in existing_tables and name not in existing]
+        for name in created:
+            connection.exec_driver_sql(statements[name][1])
+        if analyze:
+            prefix = f"{schema}." if schema else ""
+            for table in sorted({statements[name][0] for name in created}):
+                connection.exec_driver_sql(f"ANALYZE {prefix}{table}")
+    return created
+
+
+def drop_churn_indexes(engine, tables=None, schema=None):
+    """
+    Drops the churn indexes (see INDEXES) of the tables, e.g. before a bulk load.
+    :param engine: db engine object
+    :param tables: names of the tables, None for all tables with indexes
+    :param schema: schema of the tables (Postgres), None for the schema of the models
+    :return: names of the indexes
+    """
+    statements = index_statements(engine, tables, schema)
+    schema = _index_schema(engine, schema)
+    prefix = f"{schema}." if schema else ""
+    with engine.begin() as connection:
+        for name in statements:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {prefix}{name}")
+    return list(statements)
+
+
 def create_lookups(engine, modelname):
     """
     maing lookup tables
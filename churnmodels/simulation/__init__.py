@@ -1,2 +1,22 @@
-from .churnsim2 import *
-from .churnsim import ChurnSimulation as ChurnSimulationBase
+import importlib
+
+# the names of `from churnmodels.simulation import *`, the star import resolves them through __getattr__
+__all__ = ["ChurnSimulation", "ChurnSimulationBase", "assign_customer_pre", "get_engine", "setup_all", "simulate"]
+
+
+# The simulation names are imported on first use (PEP 562), so importing a light module like
+# churnmodels.simulation.customer does not load the simulation with its database dependencies.
+def __getattr__(name):
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name == "ChurnSimulationBase":
+        # the legacy Postgres-only simulation
+        value = importlib.import_module("churnmodels.simulation.churnsim").ChurnSimulation
+    else:
+        # the public names of churnsim2, formerly imported with *
+        churnsim2 = importlib.import_module("churnmodels.simulation.churnsim2")
+        if name.startswith("_") or not hasattr(churnsim2, name):
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(churnsim2, name)
+    globals()[name] = value
+    return value
@@ -1,13 +1,29 @@
 from .behavior import BehaviorModel, is_pos_def
 from .behavior import GaussianBehaviorModel as GaussianBehaviorModelBase
 # from churnmodels.conf import folder as conf_folder
-from churnmodels.simulation.customer import Customer
+from churnmodels.simulation.customer import CustomerBatch
 import pandas as pd
 import numpy as np
 
 from .. import conf
 
 
+def covariance_factor(cov):
+    '''
+    Returns a matrix L with L @ L.T == cov, so that `mean + z @ L.T` is multi-variate gaussian for standard normal z.
+    This is the Cholesky factor, for a covariance that is only positive semi-definite (e.g. behaviors with a
+    rectified log mean of 0 have zero variance) the factor is taken from the eigen decomposition instead.
+    :param cov: covariance matrix
+    :return: ndarray
+    '''
+    cov = np.asarray(cov, dtype=float)
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        eigen_values, eigen_vectors = np.linalg.eigh(cov)
+        return eigen_vectors * np.sqrt(np.maximum(eigen_values, 0.0))
+
+
 class GaussianBehaviorModel(GaussianBehaviorModelBase):
 
     def __init__(self, name, random_seed=None, version='model'):
@@ -37,8 +53,8 @@ class GaussianBehaviorModel(GaussianBehaviorModelBase):
         self.behave_cov = model[self.behave_names]
         self.min_rate = 0.01 * self.behave_means.min()
         corr_scale = (np.absolute(self.behave_cov.to_numpy()) <= 1.0).all()
-        if random_seed is not None:
-            np.random.seed(random_seed)
+        # the generator for customers generated without an explicit one, the global random state is left alone
+        self.rng = np.random.default_rng(random_seed)
         if not is_pos_def(self.behave_cov):
             if input("Matrix is not positive semi-definite: Multiply by transpose? (enter Y to proceed)") in ('y', 'Y'):
                 # https://stackoverflow.com/questions/619335/a-simple-algorithm-for-generating-positive-semidefinite-matrices
@@ -55,10 +71,41 @@ class FatTailledBehaviorModel(GaussianBehaviorModel):
 
     def __init__(self, name, random_seed=None, version=None):
         self.exp_base = 1.6
-        self.log_fun = lambda x: np.log(x) / np.log(self.exp_base)
-        self.exp_fun = lambda x: np.power(self.exp_base, x)
 
         super(FatTailledBehaviorModel, self).__init__(name, random_seed, version)
+        # the covariance is factorized once, every batch of customers reuses the factor
+        self.cov_factor = covariance_factor(self.behave_cov)
+
+    @classmethod
+    def from_arrays(cls, name, version, behave_names, behave_means, behave_cov, log_means, cov_factor,
+                    random_seed=None):
+        '''
+        Creates the model from its precomputed arrays (see ModelConfig) without reading and checking the csv file.
+        :param behave_means: ndarray of the mean rates
+        :param behave_cov: the scaled covariance
+        :param log_means: the means in log_fun scale
+        :param cov_factor: the factor of the covariance (see covariance_factor)
+        :return: FatTailledBehaviorModel
+        '''
+        model = cls.__new__(cls)
+        model.exp_base = 1.6
+        model.name = name
+        model.version = version
+        model.behave_names = np.asarray(behave_names).astype(object)
+        model.behave_means = pd.Series(behave_means, index=model.behave_names, name='mean')
+        model.behave_cov = behave_cov
+        model.min_rate = 0.01 * model.behave_means.min()
+        model.rng = np.random.default_rng(random_seed)
+        model.log_means = pd.Series(log_means, index=model.behave_names, name='mean')
+        model.cov_factor = cov_factor
+        return model
+
+    # methods instead of lambdas, so the model can be pickled to worker processes
+    def log_fun(self, x):
+        return np.log(x) / np.log(self.exp_base)
+
+    def exp_fun(self, x):
+        return np.power(self.exp_base, x)
 
     def scale_correlation_to_covariance(self):
         self.log_means = self.log_fun(self.behave_means)
@@ -72,17 +119,27 @@ class FatTailledBehaviorModel(GaussianBehaviorModel):
     def behave_var(self):
         return self.exp_fun(np.diagonal(self.behave_cov))
 
-    def generate_customer(self, start_of_month):
+    def generate_customer(self, start_of_month, rng=None):
         '''
         Given a mean and covariance matrix, the event rates for the customer are drawn from the multi-variate
         gaussian distribution.
         subtract 0.5 and set min at 0.5 per month, so there can be very low rates despite 0 (1) min in log normal sim
         :return: a Custoemr object
         '''
-        customer_rates = np.random.multivariate_normal(mean=self.log_means, cov=self.behave_cov)
-        # customer_rates=self.exp_fun(customer_rates)
+        return self.generate_customers(1, start_of_month, rng)[0]
+
+    def generate_customers(self, n, start_of_month, rng=None):
+        '''
+        Batch version of generate_customer: the (n x behaviors) matrix of log rates is drawn from the multi-variate
+        gaussian distribution using the cached Cholesky factor of the covariance, then exp_fun and the clipping are
+        applied to the whole matrix.
+        :param n: number of customers
+        :param start_of_month: datetime.date the customers are created for
+        :param rng: np.random.Generator, the generator of the model if not given
+        :return: a CustomerBatch
+        '''
+        rng = self.rng if rng is None else rng
+        normal = rng.standard_normal(size=(n, len(self.behave_names)))
+        customer_rates = np.asarray(self.log_means, dtype=float) + normal @ self.cov_factor.T
         customer_rates = np.maximum(self.exp_fun(customer_rates) - 0.667, 1)
-        # customer_rates = np.maximum(customer_rates-0.667,0.333)
-        new_customer = Customer(customer_rates, channel_name=self.version, start_of_month=start_of_month)
-        # print(customer_rates)
-        return new_customer
+        return CustomerBatch.generate(customer_rates, self.version, start_of_month, rng)
@@ -0,0 +1,82 @@
+import json
+import os
+from datetime import date
+
+import numpy as np
+
+
+class Checkpoint:
+
+    def __init__(self, method, model, start_date, end_date, entropy, month_index, next_ids, subscription_count,
+                 step=0, n_accounts=0, population=None):
+        '''
+        The state of a simulation after a finished month, enough to continue the run without recomputing the months
+        before:
+        - the random state: the entropy of the simulation seed sequence (every random stream is derived from it
+          and the month / step number)
+        - the cohort sizes: the index of the next month to add (the sizes follow from the simulation parameters)
+        - the id high-water marks: the next free account, subscription, event and event_daily id, rows written
+          after the checkpoint are removed when resuming
+        - for the cohort engine the active customers (and the ones cut off by the end date) as arrays
+        :param method: "customer" or "cohort"
+        :param model: name of the model
+        :param start_date: datetime.date start of the simulation
+        :param end_date: datetime.date end of the simulation the checkpoint was written for
+        :param entropy: int entropy of the simulation seed sequence
+        :param month_index: index of the next month whose new customers are simulated
+        :param next_ids: (account, subscription, event, event_daily) next free ids
+        :param subscription_count: number of subscriptions written so far
+        :param step: number of steps done by the cohort engine
+        :param n_accounts: number of accounts created by the cohort engine
+        :param population: dict of name -> ndarray, the ActivePopulation columns of the cohort engine
+        '''
+        self.method = method
+        self.model = model
+        self.start_date = start_date
+        self.end_date = end_date
+        self.entropy = entropy
+        self.month_index = month_index
+        self.next_ids = tuple(next_ids)
+        self.subscription_count = subscription_count
+        self.step = step
+        self.n_accounts = n_accounts
+        self.population = population or {}
+
+    def save(self, path):
+        '''
+        Writes the checkpoint as .npz file (the scalar state as json in the array 'meta'). The file is replaced
+        atomically, a crash while saving leaves the previous checkpoint.
+        :param path: file name
+        :return:
+        '''
+        meta = {
+            'method': self.method,
+            'model': self.model,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            # the entropy is a 128 bit int
+            'entropy': str(self.entropy),
+            'month_index': self.month_index,
+            'next_ids': [int(i) for i in self.next_ids],
+            'subscription_count': self.subscription_count,
+            'step': self.step,
+            'n_accounts': self.n_accounts,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **self.population)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        :param path: file name
+        :return: the Checkpoint saved in the file
+        '''
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            population = {name: data[name] for name in data.files if name != 'meta'}
+        return cls(meta['method'], meta['model'], date.fromisoformat(meta['start_date']),
+                   date.fromisoformat(meta['end_date']), int(meta['entropy']), meta['month_index'],
+                   meta['next_ids'], meta['subscription_count'], meta['step'], meta['n_accounts'],
+                   population)
@@ -2,7 +2,6 @@
 from datetime import date, timedelta
 from dateutil.relativedelta import *
 import random
-from postgres import Postgres
 from math import ceil
 import os
 import glob
@@ -12,8 +11,8 @@ import pandas as pd
 import numpy as np
 
 from churnmodels.simulation.behavior import FatTailledBehaviorModel
+from churnmodels.simulation.customer import SimulationCalendar
 from churnmodels.simulation.utility import UtilityModel
-import psycopg2 as post
 
 
 class ChurnSimulation:
@@ -34,6 +33,10 @@ class ChurnSimulation:
         self.end_date = end
         self.init_customers=init_customers
         self.monthly_growth_rate = 0.1
+        # the generator of the plans and events of the customers
+        self.rng = np.random.default_rng(seed)
+        # the day multipliers shared by all customers, including the last periods reaching over the end date
+        self.calendar = SimulationCalendar(start, (end - start).days + 62, seed)
 
         self.util_mod=UtilityModel(self.model_name)
         behavior_versions = glob.glob('../conf/'+self.model_name+'_*.csv')
@@ -59,6 +62,10 @@ class ChurnSimulation:
         self.tmp_sub_file_name = os.path.join(tempfile.gettempdir(),'{}_tmp_sub.csv'.format(self.model_name))
         self.tmp_event_file_name=os.path.join(tempfile.gettempdir(),'{}_tmp_event.csv'.format(self.model_name))
 
+        # the database drivers are only needed (and imported) by this legacy simulation
+        from postgres import Postgres
+        import psycopg2 as post
+
         self.db = Postgres("postgres://%s:%s@localhost/%s" % (
         os.environ['CHURN_DB_USER'], os.environ['CHURN_DB_PASS'], os.environ['CHURN_DB']))
 
@@ -100,7 +107,7 @@ class ChurnSimulation:
         customer_country = np.random.choice(self.country_lookup['country'],p=self.country_lookup['pcnt'])
         new_customer.country = customer_country
 
-        new_customer.pick_plan(self.plans)
+        new_customer.pick_plan(self.plans,self.rng)
 
         # Pick a random start date for the subscription within the month
         end_range = start_of_month + relativedelta(months=+1)
@@ -109,8 +116,8 @@ class ChurnSimulation:
         churned = False
         while not churned:
             next_month=this_month+relativedelta(months=1)
-            new_customer.subscriptions.append( (this_month,next_month, new_customer.mrr) )
-            month_count = new_customer.generate_events(this_month,next_month)
+            new_customer.add_subscription(this_month, next_month, new_customer.mrr)
+            month_count = new_customer.generate_events(this_month,next_month,self.calendar,self.rng)
             churned=self.util_mod.simulate_churn(month_count,new_customer) or next_month > self.end_date
             if not churned:
                 self.util_mod.simulate_upgrade_downgrade(month_count,new_customer,self.plans)
@@ -1,31 +1,45 @@
+import argparse
+import collections
 import concurrent.futures
-import glob
+import copy
+from contextlib import nullcontext
 import os
-from datetime import date
+from datetime import date, timedelta
 from math import ceil
 
-import pandas as pd
 import numpy as np
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import create_engine, func, event
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import sessionmaker
 from tqdm import tqdm
 #
-from churnmodels.schema import create_tables, create_lookups, Account, Subscription, Event
-from churnmodels.simulation.customer import Customer
-# from churnmodels.simulation.utility import UtilityModel
-from churnmodels.simulation.utility2 import UtilityModel
+from churnmodels.schema import create_tables, create_lookups, ensure_indexes
+from churnmodels.simulation.customer import Customer, CustomerBatch, SimulationCalendar, CategoricalSampler
+from churnmodels.simulation.writer import SimulatedCohort, CohortWriter, write_cohort, bulk_load, next_ids, \
+    reserve_ids, delete_rows_from
+from churnmodels.simulation.checkpoint import Checkpoint
+from churnmodels.simulation.shards import shard_files, create_shards, shard_engine, merge_shards, \
+    attach_shard_views, MAX_SHARD_VIEWS
+from churnmodels.simulation.cohort import CohortEngine
+from churnmodels.simulation.model_config import ModelConfig
 
 from churnmodels.helpers import required_envvar
-from churnmodels.simulation.behavior2 import FatTailledBehaviorModel
 from churnmodels.simulation.churnsim import ChurnSimulation as ChurnSimulationBase
-from churnmodels.conf import folder as conf_folder
 
 
 class ChurnSimulation(ChurnSimulationBase):
 
-    def __init__(self, model, start, end, init_customers, seed, engine, schema=None):
+    # number of customers simulated with one random seed, fixed so the result does not depend on the worker count
+    chunk_size = 1000
+    # first element of the spawn key of the random streams derived from the simulation seed
+    CALENDAR_STREAM = 0
+    CUSTOMER_STREAM = 1
+    COHORT_STREAM = 2
+    CALIBRATION_STREAM = 3
+
+    def __init__(self, model, start, end, init_customers, seed, engine, schema=None, workers=1,
+                 bulk_load=False, max_in_flight=4, checkpoint=None, event_mode="events", shards=0,
+                 shard_merge="copy", churn_rate=None, indexes=False):
         '''
         Creates the behavior/utility model objects, sets internal variables to prepare for simulation, and creates
         the database connection
@@ -36,6 +50,20 @@ class ChurnSimulation(ChurnSimulationBase):
         :param init_customers: how many customers to create at start date
         :param seed: set a random seed to compare simulation results
         :param engine: db engine object
+        :param workers: number of worker processes simulating the customers
+        :param bulk_load: write in the bulk-load mode of the database (SQLite: no journal, synchronous off)
+        :param max_in_flight: maximum number of simulated chunks waiting to be written to the database
+        :param checkpoint: file name of the checkpoint written after every month, None for no checkpoints
+        :param event_mode: "events" writes every event with its time stamp to the event table, "daily" only the
+            number of events per account, day and event type to the event_daily table
+        :param shards: number of SQLite files the customers are simulated into in parallel (each by one worker
+            process) before they are merged into the database, 0 to write to the database directly
+        :param shard_merge: "copy" merges the shards into the database tables, "views" leaves the shard files and
+            exposes them through views on the engine (see attach_shard_views)
+        :param churn_rate: monthly churn rate the utility model is calibrated to (see calibrate_churn), None keeps
+            the offset of the utility model
+        :param indexes: build the churn indexes (see ensure_indexes) after the simulated data is written, with
+            bulk_load they are not updated during the load
         '''
 
         self.model_name = model
@@ -45,43 +73,123 @@ class ChurnSimulation(ChurnSimulationBase):
         self.end_date = end
         self.init_customers = init_customers
         self.monthly_growth_rate = 0.1
-
-        self.util_mod = UtilityModel(self.model_name)
-
-        # path = '../conf/'
-        path = conf_folder + '/'
-        # behavior_versions = glob.glob('../conf/' + self.model_name + '_*.csv')
-        behavior_versions = glob.glob(path + self.model_name + '_*.csv')
+        self.seed = seed
+        self.workers = workers
+        self.bulk_load = bulk_load
+        self.indexes = indexes
+        self.max_in_flight = max_in_flight
+        self.checkpoint = checkpoint
+        if event_mode not in ("events", "daily"):
+            raise ValueError(f"unknown event mode '{event_mode}'")
+        self.daily_events = event_mode == "daily"
+        if shard_merge not in ("copy", "views"):
+            raise ValueError(f"unknown shard merge '{shard_merge}'")
+        if shard_merge == "views" and shards > MAX_SHARD_VIEWS:
+            raise ValueError(f"the views attach every shard, SQLite allows {MAX_SHARD_VIEWS} shards, not {shards}")
+        self.shards = shards
+        self.shard_merge = shard_merge
+        self.shard_files = None
+        self.executor = None
+        self.writer = None
+        # all random numbers of the simulation come from generators seeded by children of this sequence
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.calendar = self.simulation_calendar()
+
+        # the models are built from the compiled arrays, the csv files are only read when they changed
+        config = ModelConfig.load(self.model_name)
+        self.util_mod = config.utility_model()
         self.behavior_models = {}
         self.model_list = []
-        for b in behavior_versions:
-            version = b[(b.find(self.model_name) + len(self.model_name) + 1):-4]
-            if version in ('utility', 'population', 'country', 'plans'):
-                continue
-            behave_mod = FatTailledBehaviorModel(self.model_name, seed, version)
+        for version in config.versions:
+            behave_mod = config.behavior_model(version, seed)
             self.behavior_models[behave_mod.version] = behave_mod
             self.model_list.append(behave_mod)
 
         if len(self.behavior_models) > 1:
-            # self.population_percents = pd.read_csv('../conf/' + self.model_name + '_population.csv', index_col=0)
-            self.population_percents = pd.read_csv(path + '/' + self.model_name + '_population.csv', index_col=0)
+            self.population_percents = config.population()
         self.util_mod.setChurnScale(self.behavior_models, self.population_percents)
         self.population_picker = np.cumsum(self.population_percents)
 
-        self.plans = pd.read_csv(path + '/' + self.model_name + '_plans.csv')
-        self.country_lookup = pd.read_csv(path + '/' + self.model_name + '_country.csv')
+        self.plans = config.plans()
+        self.util_mod.set_plans(self.plans)
+        self.country_lookup = config.country()
+        self.set_samplers()
 
         self.subscription_count = 0
+        if churn_rate is not None:
+            self.calibrate_churn(churn_rate)
+
         # the data base engine canbe sqlite, postgres, ... everything that sqlalchemy knows
         # self.engine = engine
 
-    def run_simulation(self):
+    def __getstate__(self):
+        # the simulation is sent to the worker processes without its database connection and pool
+        state = self.__dict__.copy()
+        state['engine'] = None
+        state['executor'] = None
+        state['writer'] = None
+        return state
+
+    def simulation_calendar(self):
+        '''
+        :return: the day multipliers of the whole simulation (plus the last subscription periods reaching over the
+            end). The multipliers of a day do not depend on the end date, so an extended run keeps the calendar.
+        '''
+        n_days = (self.end_date - self.start_date).days + 62
+        return SimulationCalendar(self.start_date, n_days,
+                                  np.random.default_rng(self.random_stream(self.CALENDAR_STREAM)))
+
+    def set_samplers(self):
+        '''
+        Compiles the categorical distributions of new customers (behavior model, country and plan) into samplers,
+        to be called again after population_percents, country_lookup or plans are changed.
+        :return:
+        '''
+        model_percents = self.population_percents.loc[[model.version for model in self.model_list], 'pcnt']
+        self.model_sampler = CategoricalSampler(np.arange(len(self.model_list)), model_percents)
+        self.country_sampler = CategoricalSampler(self.country_lookup['country'], self.country_lookup['pcnt'])
+        self.plan_sampler = CategoricalSampler(self.plans['mrr'], self.plans['prob'])
+
+    def calibrate_churn(self, churn_rate, n_customers=1000, kappa=None, tol=1e-3):
+        '''
+        Calibration of the churn sigmoid against the simulated population: sets the offset of the utility model (see
+        UtilityModel.calibrate_offset) so the monthly churn rate of a cohort simulation is churn_rate. The simulated
+        churn rate is that of all customers active in a month, weighted by the subscribers of the month (see
+        mean_kpis), so the customers with low utility churning first are accounted for. Every bisection step runs
+        the cohort simulation in memory without events, with the dates and growth rate of this simulation,
+        n_customers initial customers and random numbers independent of those of the run.
+        :param churn_rate: the requested monthly churn rate
+        :param n_customers: number of initial customers of the calibration runs
+        :param kappa: new kappa of the churn sigmoid, by default kappa is kept
+        :param tol: tolerance of the churn rate
+        :return: the offset
+        '''
+        # sweep imports this module
+        from churnmodels.simulation.sweep import KpiCollector, mean_kpis
+
+        calibration = copy.copy(self)
+        calibration.engine = None
+        calibration.checkpoint = None
+        calibration.init_customers = n_customers
+        calibration.seed_seq = self.random_stream(self.CALIBRATION_STREAM)
+
+        def simulated_churn():
+            calibration.writer = KpiCollector(self.start_date, self.end_date)
+            CohortEngine(calibration, events=False, progress=False).run()
+            return mean_kpis(calibration.writer.result())['churn_rate']
+
+        return self.util_mod.calibrate_offset(simulated_churn, churn_rate, kappa, tol)
+
+    def run_simulation(self, method="customer", resume=False):
         '''
         Simulation test function. First it prepares the database by truncating any old events and subscriptions, and
         inserting the event types into the database.  Next it creeates the initial customers by calling
         create_customers_for_month, and then it advances month by month adding new customers (also using
         create_customers_for_month.)  The number of new customers for each month is determined from the growth rate.
         Note that churn is not handled at this level, but is modeled at the customer level.
+        :param method: "customer" simulates every customer from sign up to churn (in the worker processes),
+            "cohort" advances all active customers month by month with vectorized operations (see CohortEngine)
+        :param resume: continue the run from the checkpoint file, see load_checkpoint
         :return:
         '''
 
@@ -92,181 +200,344 @@ class ChurnSimulation(ChurnSimulationBase):
         # ...the event_types have been added already
         # self.behavior_models[next(iter(self.behavior_models))].insert_event_types(self.model_name, self.db)
 
-        # Initial customer count
-        print('\nCreating %d initial customers for month of %s' % (self.init_customers, self.start_date))
-        self.create_customers_for_month(self.start_date, self.init_customers)
-        print('Created %d initial customers with %d subscriptions for start date %s' % (
-            self.init_customers, self.subscription_count, str(self.start_date)))
+        if method not in ("customer", "cohort"):
+            raise ValueError(f"unknown simulation method '{method}'")
+        if self.shards and (method != "customer" or self.checkpoint is not None):
+            raise ValueError("sharded runs are only supported for the customer method without checkpoints")
+        state = self.load_checkpoint(method) if resume else None
+        if method == "cohort":
+            run_months = CohortEngine(self).run
+        else:
+            run_months = self._run_months
+            if self.shards:
+                self.prepare_shards()
+            if self.workers > 1:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker, initargs=(self,))
+        options = {"schema": self.schema, "product": self.model_name, "bill_period_months": 1}
+        try:
+            # the writer thread is closed (all cohorts written) before the bulk-load mode ends
+            # the shards are merged after the bulk-load mode, the indexes are built after the merge
+            load_indexes = self.indexes and not self.shards
+            with bulk_load(self.engine, indexes=load_indexes) if self.bulk_load else nullcontext(), \
+                    CohortWriter(self.engine, options, self.max_in_flight) as self.writer:
+                run_months(state)
+            if self.shards:
+                self.finish_shards()
+            if self.indexes:
+                ensure_indexes(self.engine, schema=self.schema)
+        finally:
+            self.writer = None
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def prepare_shards(self):
+        '''
+        Creates the shard files next to the database file. The account ids are reserved in the database month by
+        month, every shard counts its subscription and event ids from 1 and merge_shards reserves their ranges.
+        :return:
+        '''
+        if self.engine.dialect.name != "sqlite" or self.engine.url.database in (None, "", ":memory:"):
+            raise ValueError("sharded runs need an SQLite database file")
+        self.shard_files = shard_files(self.engine.url.database, self.shards)
+        create_shards(self.shard_files)
+        # next (subscription, event, event_daily) id of every shard
+        self.shard_ids = [(1, 1, 1)] * self.shards
+
+    def finish_shards(self):
+        if self.shard_merge == "copy":
+            print(f"Merging {self.shards} shards into {self.engine.url.database}")
+            merge_shards(self.engine, self.shard_files, self.shard_ids)
+        else:
+            attach_shard_views(self.engine, self.shard_files, self.shard_ids)
 
-        # return
+    def load_checkpoint(self, method):
+        '''
+        Prepares resuming the run from the checkpoint file: the seed of the checkpointed run is taken over and the
+        rows written after the checkpoint (by the month that did not finish) are deleted. A cohort simulation can
+        also be extended to a later end date than the checkpointed one.
+        :param method: the simulation method, must be the one of the checkpoint
+        :return: the Checkpoint
+        '''
+        state = Checkpoint.load(self.checkpoint)
+        if (state.method, state.model, state.start_date) != (method, self.model_name, self.start_date):
+            raise ValueError(f"the checkpoint {self.checkpoint} is for a {state.method} simulation of {state.model} "
+                             f"from {state.start_date}")
+        if self.end_date < state.end_date or (method == "customer" and self.end_date != state.end_date):
+            # the customer simulation follows every customer up to the end date, those are not in the checkpoint
+            raise ValueError(f"a {method} simulation to {state.end_date} can not be continued to {self.end_date}")
+        self.seed_seq = np.random.SeedSequence(state.entropy)
+        self.calendar = self.simulation_calendar()
+        self.subscription_count = state.subscription_count
+        delete_rows_from(self.engine, state.next_ids, self.schema)
+        return state
+
+    def save_checkpoint(self, method, month_index, **cohort_state):
+        '''
+        Writes the checkpoint file (if the simulation has one) after all cohorts handed to the writer are written.
+        :param method: the simulation method
+        :param month_index: index of the next month whose new customers are simulated
+        :param cohort_state: step, n_accounts and population of the cohort engine
+        :return:
+        '''
+        if self.checkpoint is None:
+            return
+        self.writer.flush()
+        Checkpoint(method, self.model_name, self.start_date, self.end_date, self.seed_seq.entropy, month_index,
+                   next_ids(self.engine), self.subscription_count, **cohort_state).save(self.checkpoint)
 
-        # Advance to additional months
+    def monthly_cohort_sizes(self, first_month=0):
+        '''
+        The number of new customers per month: init_customers at the start date, then growing by the monthly growth
+        rate. Sets month_index to the number of the month yielded.
+        :param first_month: index of the first month yielded, the months before are skipped
+        :return: generator of (month start date, number of new customers)
+        '''
+        self.month_index = 0
+        if first_month == 0:
+            yield self.start_date, self.init_customers
         next_month = self.start_date + relativedelta(months=+1)
         n_to_add = int(ceil(self.init_customers * self.monthly_growth_rate))  # number of new customers in first month
         while next_month < self.end_date:
-            print('\nCreating %d new customers for month of %s:' % (n_to_add, next_month))
-            self.create_customers_for_month(next_month, n_to_add)
-            print('Created %d new customers for month %s, now %d subscriptions\n' % (
-                n_to_add, str(next_month), self.subscription_count))
+            self.month_index += 1
+            if self.month_index >= first_month:
+                yield next_month, n_to_add
             next_month = next_month + relativedelta(months=+1)
             n_to_add = int(ceil(n_to_add * (1.0 + self.monthly_growth_rate)))  # increase the new customers by growth
 
-        # self.remove_tmp_files()
+    def _run_months(self, state=None):
+        for month_date, n_to_add in self.monthly_cohort_sizes(0 if state is None else state.month_index):
+            if self.month_index == 0:
+                # Initial customer count
+                print('\nCreating %d initial customers for month of %s' % (n_to_add, month_date))
+                self.create_customers_for_month(month_date, n_to_add)
+                print('Created %d initial customers with %d subscriptions for start date %s' % (
+                    n_to_add, self.subscription_count, str(month_date)))
+            else:
+                print('\nCreating %d new customers for month of %s:' % (n_to_add, month_date))
+                self.create_customers_for_month(month_date, n_to_add)
+                print('Created %d new customers for month %s, now %d subscriptions\n' % (
+                    n_to_add, str(month_date), self.subscription_count))
+            self.save_checkpoint("customer", self.month_index + 1)
+
+    def random_stream(self, *key):
+        '''
+        A child of the simulation seed sequence, the same as SeedSequence.spawn creates it but addressed by its key,
+        so a worker derives the stream of its chunk (or a resumed run the stream of its month) without the parent.
+        :param key: ints, the spawn key of the stream below the simulation seed sequence
+        :return: np.random.SeedSequence, seed of an np.random.Generator
+        '''
+        return np.random.SeedSequence(self.seed_seq.entropy, spawn_key=self.seed_seq.spawn_key + key)
+
+    def generate_customers(self, start_of_month, n_to_create, rng):
+        '''
+        Generates all new customers of a month as one CustomerBatch: the behavior model of each customer is picked
+        from the population percents, every behavior model creates its share of customers in one batch, and the
+        countries and plans are drawn for the whole month at once with the samplers of set_samplers.
+        :param start_of_month: the month start date
+        :param n_to_create: number of customers to create within that month
+        :param rng: np.random.Generator
+        :return: a CustomerBatch in random order of the behavior models
+        '''
+        model_idx = self.model_sampler.codes(n_to_create, rng)
+        batches = [model.generate_customers(np.count_nonzero(model_idx == i), start_of_month, rng)
+                   for i, model in enumerate(self.model_list)]
+        # the batches are ordered by model, put them back into the order the models were picked
+        order = np.argsort(model_idx, kind='stable')
+        batch = CustomerBatch.concat(batches).take(np.argsort(order, kind='stable'))
+
+        batch.country = self.country_sampler.sample(n_to_create, rng)
+        batch.mrr = self.plan_sampler.sample(n_to_create, rng)
+        return batch
+
+    def simulate_customer(self, start_of_month, new_customer, rng):
+        '''
+        Simulate one customer collecting its events and subscriptions.
+
+        The customer (with country and plan already set) is usually taken from the batch of generate_customers, if
+        none is given a single customer is generated. Then the customer objects simulates the events month by month,
+        and the utility model determines if there is a churn based on the simulated event counts.
+
+        :param start_of_month:
+        :param new_customer: a Customer object, e.g. taken from a CustomerBatch, None to generate one
+        :param rng: np.random.Generator
+        :return: the new customer object it contains the events and subscriptions
+        '''
+        if new_customer is None:
+            new_customer = self.generate_customers(start_of_month, 1, rng)[0]
+
+        # Pick a random start date for the subscription within the month
+        end_range = start_of_month + relativedelta(months=+1)
+        this_month = start_of_month + timedelta(days=int(rng.integers((end_range - start_of_month).days)))
+
+        churned = False
+        while not churned:
+            next_month = this_month + relativedelta(months=1)
+            new_customer.add_subscription(this_month, next_month, new_customer.mrr)
+            month_count = new_customer.generate_events(this_month, next_month, self.calendar, rng,
+                                                       daily=self.daily_events)
+            churned = self.util_mod.simulate_churn(month_count, new_customer, rng) or next_month > self.end_date
+            if not churned:
+                self.util_mod.simulate_upgrade_downgrade(month_count, new_customer, self.plans, rng)
+                this_month = next_month
+        return new_customer
+
+    def chunk_seed(self, chunk_index):
+        '''
+        The random seed for one chunk of customers, derived from the simulation seed, the month and the chunk number.
+        :param chunk_index: number of the chunk within the current month
+        :return: np.random.SeedSequence
+        '''
+        return self.random_stream(self.CUSTOMER_STREAM, self.month_index, chunk_index)
+
+    def simulate_chunk(self, month_date, n_to_create, seed):
+        '''
+        Generates and simulates one chunk of new customers with its own random seed.
+        :param month_date: the month start date
+        :param n_to_create: number of customers in the chunk
+        :param seed: the random seed of the chunk (see chunk_seed)
+        :return: a SimulatedCohort with the simulated customers
+        '''
+        rng = np.random.default_rng(seed)
+        new_customers = self.generate_customers(month_date, n_to_create, rng)
+        customers = [self.simulate_customer(month_date, new_customer, rng) for new_customer in new_customers]
+        return SimulatedCohort.from_customers(customers, daily=self.daily_events)
+
+    def simulated_chunks(self, month_date, chunk_sizes, seeds):
+        '''
+        Simulates the chunks of a month in order, in the worker processes (or in this process for a single worker).
+        At most two chunks per worker are submitted ahead of the one consumed, so the finished chunks do not pile up
+        while the writer is behind.
+        :param month_date: the month start date
+        :param chunk_sizes: number of customers of each chunk
+        :param seeds: the random seed of each chunk
+        :return: generator of SimulatedCohort
+        '''
+        if self.executor is None:
+            for n, seed in zip(chunk_sizes, seeds):
+                yield self.simulate_chunk(month_date, n, seed)
+            return
+        pending = collections.deque()
+        for n, seed in zip(chunk_sizes, seeds):
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().result()
+            pending.append(self.executor.submit(_simulate_chunk, month_date, n, seed))
+        while pending:
+            yield pending.popleft().result()
+
+    def simulate_shard(self, path, month_date, chunk_sizes, seeds, first_accounts, first_ids):
+        '''
+        Simulates chunks of a month and writes them to a shard file, with account ids allocated by the caller and
+        the subscription and event ids continuing the ones of the shard. No other process writes to the shard
+        meanwhile.
+        :param path: file name of the shard
+        :param month_date: the month start date
+        :param chunk_sizes: number of customers of each chunk
+        :param seeds: the random seed of each chunk
+        :param first_accounts: the account id of the first customer of each chunk
+        :param first_ids: next (subscription, event, event_daily) id of the shard
+        :return: number of subscriptions written, the next (subscription, event, event_daily) id of the shard
+        '''
+        engine = shard_engine(path)
+        options = {"schema": None, "product": self.model_name, "bill_period_months": 1}
+        n_subscriptions = 0
+        next_subscription, next_event, next_daily = first_ids
+        try:
+            for n, seed, first_account in zip(chunk_sizes, seeds, first_accounts):
+                chunk = self.simulate_chunk(month_date, n, seed)
+                write_cohort(chunk, engine, options,
+                             first_ids=(first_account, next_subscription, next_event, next_daily))
+                n_subscriptions += chunk.n_subscriptions
+                next_subscription += chunk.n_subscriptions
+                if self.daily_events:
+                    next_daily += chunk.n_events
+                else:
+                    next_event += chunk.n_events
+        finally:
+            engine.dispose()
+        return n_subscriptions, (next_subscription, next_event, next_daily)
+
+    def create_customers_in_shards(self, month_date, chunk_sizes, seeds):
+        '''
+        Creates the customers of a month in the shards: shard k simulates the chunks k, k + shards, ... in one task,
+        all shards of the month in parallel.
+        :param month_date: the month start date
+        :param chunk_sizes: number of customers of each chunk
+        :param seeds: the random seed of each chunk
+        :return:
+        '''
+        first_account = reserve_ids(self.engine, (sum(chunk_sizes), 0, 0, 0))[0]
+        first_accounts = first_account + np.concatenate([[0], np.cumsum(chunk_sizes)[:-1]]).astype(int)
+        tasks = [(path, month_date, chunk_sizes[k::self.shards], seeds[k::self.shards],
+                  first_accounts[k::self.shards].tolist(), self.shard_ids[k])
+                 for k, path in enumerate(self.shard_files)]
+        if self.executor is None:
+            results = [self.simulate_shard(*task) for task in tasks]
+        else:
+            results = [future.result() for future in [self.executor.submit(_simulate_shard, *task) for task in tasks]]
+        for k, (n_subscriptions, next_ids_of_shard) in enumerate(results):
+            self.subscription_count += n_subscriptions
+            self.shard_ids[k] = next_ids_of_shard
 
     def create_customers_for_month(self, month_date, n_to_create):
         '''
-        Creates all the customers for one month, by calling simulate_customer and copy_customer_to_database in a loop.
+        Creates all the customers for one month: the customers are split into chunks of chunk_size, and every chunk
+        is handed to the writer as soon as it is simulated. The writer thread writes it to the database while the
+        next chunks are simulated.
         :param month_date: the month start date
         :param n_to_create: number of customers to create within that month
         :return:
         '''
 
-        items1 = range(n_to_create)
+        chunk_sizes = [min(self.chunk_size, n_to_create - start) for start in range(0, n_to_create, self.chunk_size)]
+        seeds = [self.chunk_seed(i) for i in range(len(chunk_sizes))]
+        if self.shard_files is not None:
+            self.create_customers_in_shards(month_date, chunk_sizes, seeds)
+            return
         pbar1 = tqdm(total=n_to_create, desc="Simulated Customers", ascii=True, position=0,
                      bar_format="{l_bar}{bar:50}{r_bar}{bar:-10b}")
 
-        def substep():
-            customer0 = self.simulate_customer(month_date)
-            customer0.delta_subscriptions = len(customer0.subscriptions)
-            customer0.delta_events = len(customer0.events)
-
+        for chunk in self.simulated_chunks(month_date, chunk_sizes, seeds):
+            self.subscription_count += chunk.n_subscriptions
+            self.writer.put(chunk)
             # showing the progress bar...
-            pbar1.update(1)
-            return customer0
+            pbar1.update(chunk.n_accounts)
+        pbar1.close()
 
-        customers_sim = mainloop_threading(substep, items1)
-        total_subscriptions = sum(x.delta_subscriptions for x in customers_sim)
-        total_events = sum(x.delta_events for x in customers_sim)
-        self.subscription_count += total_subscriptions
 
-        options = {"schema": self.schema, "product": self.model_name, "bill_period_months": 1}
-        assign_customer_pre(customers_sim, self.engine, options=options)
+# the simulation object of a worker process, set once by _init_worker
+_worker_sim = None
+
+
+def _init_worker(churn_sim):
+    global _worker_sim
+    _worker_sim = churn_sim
+
+
+def _simulate_chunk(month_date, n_to_create, seed):
+    return _worker_sim.simulate_chunk(month_date, n_to_create, seed)
+
+
+def _simulate_shard(*task):
+    return _worker_sim.simulate_shard(*task)
 
 
 def assign_customer_pre(customers, engine, options):
     """
     Putting the simulated data into the database
-    customers are completely stored in an array of Python objects
-
-    :param customers:
-    :type
-    :param engine:
-    :type engine:
-    :param options:
-    :type options:
-    :return:
-    :rtype:
-    """
-    """
-    :arg
-    """
-    session = sessionmaker(bind=engine)()
-
-    n_to_create = len(customers)
-
-    pbar0 = tqdm(total=n_to_create, desc="Writing Accounts", ascii=True, position=0,
-                 bar_format="{l_bar}{bar:50}{r_bar}{bar:-10b}")
-
-    df = pd.DataFrame({
-        'channel': pd.Series([], dtype='str'),
-        'date_of_birth': pd.Series([], dtype='datetime64[ns]'),
-        'country': pd.Series([], dtype='str')})
-
-    for customer in customers:
-        df = df.append(
-            [{"channel": customer.channel, "date_of_birth": customer.date_of_birth, "country": customer.country}])
-        # showing the progress bar...
-        pbar0.update(1)
-
-    # getting the last id (primary key)
-    maxidx = session.query(func.max(Account.id)).one()[0] or 0
-    session.commit()
-    maxidxs = session.query(func.max(Subscription.id)).one()[0] or 0
-    session.commit()
-    maxidxe = session.query(func.max(Event.id)).one()[0] or 0
-    session.commit()
-
-    subs_delta = sum(len(x.subscriptions) for x in customers)
-    events_delta = sum(len(x.events) for x in customers)
-    # print(subs_delta)
-    mm = subs_delta + events_delta
-    pbar1 = tqdm(total=mm, desc="Writing Subs/Events", ascii=True, position=0,
-                 bar_format="{l_bar}{bar:50}{r_bar}{bar:-10b}")
-
-    df_s0 = []
-    df_e0 = []
-    index = maxidx + 1
-    for customer in customers:
-        account_id = index
-        for subs in customer.subscriptions:
-            df_s0.append({
-                "account_id": account_id, "start_date": subs[0], "end_date": subs[1],
-                "product": options["product"], "mrr": subs[2],
-                "bill_period_months": options["bill_period_months"]
-            })
-            # showing the progress bar...
-            pbar1.update(1)
-        for subs in customer.events:
-            df_e0.append(
-                {
-                    "account_id": account_id, "event_time": subs[0],
-                    "event_type_id": subs[1] + 1
-                })
-            # showing the progress bar...
-            pbar1.update(1)
-        index += 1
+    customers are completely stored in an array of Python objects, they are collected column wise and written by
+    write_cohort
 
-    # accounts
-    df.index = pd.RangeIndex(maxidx + 1, maxidx + 1 + len(df.index))
-
-    db_opts = {
-        "if_exists": "append",
-        "index": False
-    }
-    #print(options)
-    if options["schema"] is not None:
-        db_opts["schema"] = options["schema"]
-    df.to_sql("account", engine, **db_opts)
-
-    # subscriptions & events
-    df_s = pd.DataFrame({
-        'account_id': pd.Series([], dtype='int'),
-        'start_date': pd.Series([], dtype='datetime64[ns]'),
-        'end_date': pd.Series([], dtype='datetime64[ns]'),
-        'product': pd.Series([], dtype='str'),
-        'bill_period_months': pd.Series([], dtype='int'),
-        'mrr': pd.Series([], dtype='float')})
-    df_e = pd.DataFrame({
-        'account_id': pd.Series([], dtype='int'),
-        'event_time': pd.Series([], dtype='datetime64[ns]'),
-        'event_type_id': pd.Series([], dtype='int')})
-    df_s = df_s.append(df_s0, ignore_index=True)
-    df_e = df_e.append(df_e0, ignore_index=True)
-    df_s.index = pd.RangeIndex(maxidxs + 1, maxidxs + 1 + len(df_s.index))
-    df_e.index = pd.RangeIndex(maxidxe + 1, maxidxe + 1 + len(df_e.index))
-
-    db_opts = {"index": False, "chunksize": 10000, "if_exists": "append"}
-    if options["schema"] is not None:
-        db_opts["schema"] = options["schema"]
-
-    # storing into the DB (by the help of pandas)
-    df_s.to_sql("subscription", engine, **db_opts)
-    df_e.to_sql("event", engine, **db_opts)
-    session.commit()
+    :param customers: list of simulated Customer objects
+    :param engine: db engine object
+    :param options: dict with schema, product and bill_period_months
+    :return: the customers
+    """
+    write_cohort(SimulatedCohort.from_customers(customers), engine, options)
     return customers
 
 
-def mainloop_threading(someroutine, items):
-    results = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for x in items:
-            futures.append(executor.submit(someroutine))
-        for future in concurrent.futures.as_completed(futures):
-            results.append(future.result())
-    return results
-
-
 def _beh_generate_customer(start_of_month, log_means, behave_cov, channel_name):
     '''
     Given a mean and covariance matrix, the event rates for the customer are drawn from the multi-variate
@@ -361,21 +632,55 @@ def simulate(options={}):
         "seed": 5432,
         "init_customers": 100,
         "schema": schema,
+        "workers": 1,
+        "bulk_load": False,
+        "max_in_flight": 4,
+        "checkpoint": None,
+        "event_mode": "events",
+        "shards": 0,
+        "shard_merge": "copy",
+        "churn_rate": None,
+        "indexes": False,
     }
+    method = options.get("method", "customer")
+    # resuming continues in the existing tables, otherwise they are created from scratch
+    resume = options.get("resume", False)
     for key, val in options.items():
         # if key == "schema":
         #     continue
         if key in parameters:
             parameters[key] = options[key]
-    engine = setup_all(parameters["model"])
+    engine = get_engine() if resume else setup_all(parameters["model"])
 
     if os.getenv("CHURN_DB_DIALECT")=="sqlite":
         del parameters["schema"]
     churn_sim = ChurnSimulation(engine=engine, **parameters)
-    churn_sim.run_simulation()
+    churn_sim.run_simulation(method, resume)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="simulate churn data into the database given by the environment")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--bulk-load", action="store_true", help="write in the bulk-load mode of the database")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="maximum number of simulated chunks waiting to be written")
+    parser.add_argument("--checkpoint", help="file name of the checkpoint written after every month")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run from the checkpoint (a cohort run may get a later end date)")
+    parser.add_argument("--event-mode", choices=["events", "daily"], default="events",
+                        help="write single time stamped events or the event counts per account and day")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="number of SQLite files simulated into in parallel and merged at the end")
+    parser.add_argument("--shard-merge", choices=["copy", "views"], default="copy",
+                        help="copy the shards into the database or expose them through views")
+    parser.add_argument("--churn-rate", type=float,
+                        help="calibrate the utility model to this monthly churn rate")
+    parser.add_argument("--indexes", action="store_true",
+                        help="build the indexes of the churn queries after the data is written")
+    parser.add_argument("--method", choices=["customer", "cohort"], default="customer",
+                        help="simulate customer by customer or the whole population month by month")
+    args = parser.parse_args()
+
     churnmodel = os.getenv("CHURN_MODEL")
     schema = os.getenv("CHURN_DB_SCHEMA") if os.getenv("CHURN_DB_DIALECT") == "postgres" else None
     start = date(2020, 1, 1)
@@ -383,7 +688,11 @@ if __name__ == '__main__':
     init_customers = 10000
 
     random_seed = 5432
-    engine = setup_all(churnmodel)
-
-    churn_sim = ChurnSimulation(churnmodel, start, end, init_customers, random_seed, engine, schema)
-    churn_sim.run_simulation()
+    engine = get_engine() if args.resume else setup_all(churnmodel)
+
+    churn_sim = ChurnSimulation(churnmodel, start, end, init_customers, random_seed, engine, schema,
+                                workers=args.workers, bulk_load=args.bulk_load,
+                                max_in_flight=args.max_in_flight, checkpoint=args.checkpoint,
+                                event_mode=args.event_mode, shards=args.shards, shard_merge=args.shard_merge,
+                                churn_rate=args.churn_rate, indexes=args.indexes)
+    churn_sim.run_simulation(args.method, args.resume)
@@ -0,0 +1,231 @@
+import numpy as np
+from tqdm import tqdm
+
+from churnmodels.simulation.customer import SECONDS_PER_DAY, add_months
+from churnmodels.simulation.writer import SimulatedCohort
+
+
+class ActivePopulation:
+    fields = ('account_index', 'behave_per_month', 'satisfaction', 'plan', 'period_start')
+
+    def __init__(self, account_index, behave_per_month, satisfaction, plan, period_start):
+        '''
+        All active customers of a cohort simulation as arrays, one row per customer.
+        :param account_index: ndarray (n) index of the account within the run
+        :param behave_per_month: ndarray (n x behaviors) of behavior rates PER MONTH
+        :param satisfaction: ndarray (n) of satisfaction propensities
+        :param plan: ndarray (n) index of the current plan (row of the plans table)
+        :param period_start: ndarray (n) datetime64[D], start of the current subscription period
+        '''
+        self.account_index = account_index
+        self.behave_per_month = behave_per_month
+        self.satisfaction = satisfaction
+        self.plan = plan
+        self.period_start = period_start
+
+    @classmethod
+    def empty(cls, n_behaviors):
+        return cls(np.empty(0, dtype=np.int64), np.empty((0, n_behaviors)), np.empty(0), np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype='datetime64[D]'))
+
+    def append(self, other):
+        return ActivePopulation(*[np.concatenate([getattr(self, name), getattr(other, name)]) for name in self.fields])
+
+    def columns(self, prefix=''):
+        '''
+        :return: dict of prefix + field name -> ndarray, e.g. for a Checkpoint
+        '''
+        return {prefix + name: getattr(self, name) for name in self.fields}
+
+    @classmethod
+    def from_columns(cls, columns, prefix=''):
+        return cls(*[columns[prefix + name] for name in cls.fields])
+
+    def take(self, index):
+        return ActivePopulation(self.account_index[index], self.behave_per_month[index], self.satisfaction[index],
+                                self.plan[index], self.period_start[index])
+
+    def __len__(self):
+        return len(self.account_index)
+
+
+class CohortEngine:
+    # number of customers whose daily event counts are drawn at once (bounds the size of the count tensor)
+    block_size = 16384
+
+    def __init__(self, churn_sim, events=True, progress=True):
+        '''
+        Month-stepped simulation: instead of following every customer from sign up to churn, all active customers are
+        kept as arrays and the whole population is advanced one subscription period at a time. The event counts, the
+        utility, the churn draws and the up/downgrades are evaluated vectorized for all customers of a month.
+        The semantics are those of ChurnSimulation.simulate_customer: a customer starts on a random day of the month
+        of sign up, every period lasts one month, the churn is drawn from the event counts of the period and customers
+        are cut off with the first period ending after the end date.
+        :param churn_sim: the ChurnSimulation with the models, dates and database engine
+        :param events: generate the event rows, False only draws the event counts the churn depends on (the cohorts
+            handed to the writer have no events)
+        :param progress: show a progress bar
+        '''
+        self.sim = churn_sim
+        self.calendar = churn_sim.calendar
+        self.events = events
+        self.progress = progress
+
+    def run(self, state=None):
+        '''
+        Runs the simulation month by month and hands accounts, subscriptions and events of each month to the writer
+        of the simulation, a checkpoint is saved after every month with new customers. The months after the last
+        one only finish the periods up to the end date, a resumed run simulates them again.
+        Customers whose next period starts after the end date are not dropped but kept aside in the checkpoint, so
+        the run can be extended to a later end date and gives the same data as a run to that date.
+        :param state: the Checkpoint to resume from, None to start a new run
+        :return:
+        '''
+        sim = self.sim
+        end = np.datetime64(sim.end_date, 'D')
+        if state is None:
+            active = ActivePopulation.empty(len(sim.util_mod.behave_names))
+            after_end = ActivePopulation.empty(len(sim.util_mod.behave_names))
+            n_accounts = 0
+            step = 0
+            month_index = 0
+        else:
+            n_accounts, step, month_index = state.n_accounts, state.step, state.month_index
+            active = ActivePopulation.from_columns(state.population, 'active_')
+            after_end = ActivePopulation.from_columns(state.population, 'after_end_')
+            # customers cut off by an earlier end date continue if their next period starts before the new one
+            continued = after_end.period_start <= end
+            active = active.append(after_end.take(continued))
+            # in the order of the accounts like in an uninterrupted run, the random draws go by position
+            active = active.take(np.argsort(active.account_index, kind='stable'))
+            after_end = after_end.take(~continued)
+
+        months = sim.monthly_cohort_sizes(month_index)
+        month_date, n_to_add = next(months, (None, 0))
+        pbar = tqdm(desc="Simulated subscriber months", ascii=True, position=0, disable=not self.progress,
+                    bar_format="{l_bar}{bar:50}{r_bar}{bar:-10b}")
+        while month_date is not None or len(active) > 0:
+            # every month has its own random stream
+            rng = np.random.default_rng(sim.random_stream(sim.COHORT_STREAM, step))
+            accounts = {'channel': np.empty(0, dtype=object), 'date_of_birth': np.empty(0, dtype='datetime64[D]'),
+                        'country': np.empty(0, dtype=object)}
+            if month_date is not None:
+                accounts, new_active = self.new_customers(month_date, n_to_add, n_accounts, rng)
+                active = active.append(new_active)
+                month_index = sim.month_index + 1
+            n_subscribers = len(active)
+
+            subscriptions, events, active, cut_off = self.advance(active, rng)
+            after_end = after_end.append(cut_off)
+            sim.writer.put(SimulatedCohort(accounts, subscriptions, events, account_base=n_accounts))
+            n_accounts += len(accounts['channel'])
+            sim.subscription_count += len(subscriptions['account_index'])
+            pbar.update(n_subscribers)
+            step += 1
+            if month_date is not None:
+                population = active.columns('active_')
+                population.update(after_end.columns('after_end_'))
+                sim.save_checkpoint("cohort", month_index, step=step, n_accounts=n_accounts, population=population)
+            month_date, n_to_add = next(months, (None, 0))
+        pbar.close()
+
+    def new_customers(self, month_date, n_to_create, n_accounts, rng):
+        '''
+        Generates the customers signing up in a month, each starting on a random day of the month.
+        :param month_date: the month start date
+        :param n_to_create: number of customers
+        :param n_accounts: number of accounts created before (account_index of the first new customer)
+        :param rng: np.random.Generator
+        :return: the account columns, the new customers as ActivePopulation
+        '''
+        batch = self.sim.generate_customers(month_date, n_to_create, rng)
+        month_start = np.datetime64(month_date, 'D')
+        days_in_month = (add_months(month_start, 1) - month_start).astype(np.int64)
+        start = month_start + rng.integers(days_in_month, size=n_to_create).astype('timedelta64[D]')
+
+        accounts = {'channel': batch.channel, 'date_of_birth': batch.date_of_birth, 'country': batch.country}
+        plan = self.sim.util_mod.plan_of(batch.mrr)
+        new_active = ActivePopulation(np.arange(n_accounts, n_accounts + n_to_create), batch.behave_per_month,
+                                      batch.satisfaction, plan, start)
+        return accounts, new_active
+
+    def advance(self, active, rng):
+        '''
+        Simulates one subscription period for all active customers.
+        :param active: ActivePopulation
+        :param rng: np.random.Generator
+        :return: subscription columns, event columns, the customers still active in the next period, the customers
+            not churned but cut off by the end date
+        '''
+        util_mod = self.sim.util_mod
+        period_end = add_months(active.period_start, 1)
+        subscriptions = {'account_index': active.account_index, 'start_date': active.period_start,
+                         'end_date': period_end, 'mrr': util_mod.plan_mrr[active.plan]}
+
+        counts, events = self.generate_events(active, period_end, rng)
+        utility = util_mod.utility_batch(counts, active.satisfaction)
+        churned = util_mod.churn_batch(counts, active.satisfaction, utility=utility, rng=rng)
+        # the plan of the next period is drawn for all customers not churned, also for those cut off by the end date:
+        # the draws do not depend on the end date and an extended run continues them with their next plan
+        active = active.take(~churned)
+        period_end = period_end[~churned]
+        active.plan = util_mod.upgrade_downgrade_batch(counts[~churned], active.satisfaction, active.plan,
+                                                       utility=utility[~churned], rng=rng)
+        active.period_start = period_end
+
+        cut_off = period_end > np.datetime64(self.sim.end_date, 'D')
+        return subscriptions, events, active.take(~cut_off), active.take(cut_off)
+
+    def generate_events(self, active, period_end, rng):
+        '''
+        Draws the daily event counts of the period for all active customers, in blocks of block_size customers: a
+        (customers x days x event types) Poisson tensor at the daily rates, scaled by the day multipliers. Days
+        after the end of a customer's period have rate 0. For daily event counts the events are not expanded into
+        time stamps, the event columns have one row per customer, day and event type with its count n.
+        :param active: ActivePopulation
+        :param period_end: ndarray (n) datetime64[D]
+        :param rng: np.random.Generator
+        :return: (n x event types) count matrix, event columns
+        '''
+        n, n_types = active.behave_per_month.shape
+        max_days = 31
+        counts = np.zeros((n, n_types), dtype=np.int64)
+        event_parts = []
+        for block_start in range(0, n, self.block_size):
+            block = slice(block_start, min(block_start + self.block_size, n))
+            first_day = self.calendar.day_offset(active.period_start[block])
+            n_days = (period_end[block] - active.period_start[block]).astype(np.int64)
+            day = np.arange(max_days)
+            in_period = day[np.newaxis, :] < n_days[:, np.newaxis]
+            day_offset = np.minimum(first_day[:, np.newaxis] + day, len(self.calendar) - 1)
+            multipliers = self.calendar.multipliers[day_offset] * in_period
+
+            rates = (1.0 / 30.0) * active.behave_per_month[block]
+            daily_counts = rng.poisson(rates[:, np.newaxis, :] * in_period[:, :, np.newaxis])
+            daily_counts = np.rint(multipliers[:, :, np.newaxis] * daily_counts).astype(np.int64)
+            counts[block] = daily_counts.sum(axis=1)
+            if not self.events:
+                continue
+
+            if self.sim.daily_events:
+                # one row per customer, day and event type with events
+                cells = np.flatnonzero(daily_counts)
+            else:
+                cells = np.repeat(np.arange(daily_counts.size), daily_counts.ravel())
+            row, rest = np.divmod(cells, max_days * n_types)
+            event_day, event_type = np.divmod(rest, n_types)
+            start_seconds = active.period_start[block].astype('datetime64[s]').astype(np.int64)
+            part = {
+                'account_index': active.account_index[block][row],
+                'event_time': start_seconds[row] + SECONDS_PER_DAY * event_day,
+                'event_type': event_type.astype(np.int16),
+            }
+            if self.sim.daily_events:
+                part['n'] = daily_counts.ravel()[cells]
+            else:
+                part['event_time'] += rng.integers(SECONDS_PER_DAY, size=cells.size)
+            event_parts.append(part)
+        names = ('account_index', 'event_time', 'event_type') + (('n',) if self.sim.daily_events else ())
+        events = {name: np.concatenate([part[name] for part in event_parts]) if event_parts
+                  else np.empty(0, dtype=np.int64) for name in names}
+        return counts, events
@@ -1,26 +1,79 @@
 
-from datetime import date, datetime, timedelta,time
 from dateutil import relativedelta
 #from numpy import random
 #from random import randrange, uniform
 import numpy as np
 
 
+class ArrayBuffer:
+    __slots__ = ('data', 'size')
+
+    def __init__(self, dtype, values=()):
+        '''
+        A growable typed array: values are appended in blocks, the storage doubles when it is full.
+        :param dtype: numpy dtype of the values
+        :param values: initial values
+        '''
+        self.data = np.asarray(values, dtype=dtype)
+        self.size = len(self.data)
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        new_size = self.size + len(values)
+        if new_size > len(self.data):
+            grown = np.empty(max(new_size, 2 * len(self.data), 16), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:new_size] = values
+        self.size = new_size
+
+    def append(self, value):
+        self.extend([value])
+
+    @property
+    def values(self):
+        '''
+        :return: ndarray view of the filled part of the buffer
+        '''
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"ArrayBuffer({self.values!r})"
+
+    # only the filled part is pickled (sent back from the worker processes)
+    def __getstate__(self):
+        return self.values.copy()
+
+    def __setstate__(self, state):
+        self.data = state
+        self.size = len(state)
+
 
 class Customer:
+    __slots__ = ('id', 'behave_per_month', 'behave_per_day', 'channel', 'age', 'date_of_birth', 'country', 'mrr',
+                 'satisfaction_propensity', 'subscription_start', 'subscription_end', 'subscription_mrr',
+                 'event_times', 'event_types', 'event_counts')
     id_counter=0
     MIN_AGE = 12.0
     MAX_AGE = 82.0
     AGE_RANGE = MAX_AGE - MIN_AGE
     AVG_AGE = (MAX_AGE + MIN_AGE) / 2.0
-    date_multipliers = {}
 
-    def __init__(self,behavior_rates,satisfaction=None,channel_name='NA',start_of_month=None,country=None):
+    def __init__(self,behavior_rates,satisfaction=None,channel_name='NA',start_of_month=None,country=None,
+                 date_of_birth=None,rng=None):
         '''
         Creates a customer for simulation, given an ndarray of behavior rates, which are converted to daily.
         Each customer also has a unique integer id which will become the account_id in the database, and holds its
-        own subscriptions and events.
+        own subscriptions and events. They are kept column wise in typed buffers: subscription start and end as
+        datetime64[D] and the mrr, the events as int64 seconds since the epoch and int16 event type index (for daily
+        event counts the start of the day, the type and the number of events in event_counts).
         :param behavior_rates: ndarray of behavior rates, which are assumed to be PER MONTH
+        :param date_of_birth: used when no start_of_month is given (e.g. a customer taken from a CustomerBatch)
+        :param rng: np.random.Generator for the age and satisfaction, the global numpy random state (seeded with
+            np.random.seed by the legacy simulation) if not given
         '''
         self.id=Customer.id_counter # set the id to the current class variable
         Customer.id_counter+=1 # increment the class variable
@@ -29,64 +82,295 @@ class Customer:
         self.behave_per_day = (1.0/30.0)*self.behave_per_month
         self.channel=channel_name
 
+        if rng is None:
+            rng = np.random
         if start_of_month:
-            self.age=np.random.uniform(Customer.MIN_AGE,Customer.MAX_AGE)
+            self.age=rng.uniform(Customer.MIN_AGE,Customer.MAX_AGE)
             self.date_of_birth = start_of_month + relativedelta.relativedelta(years=-int(self.age),
                                                                               months=-int( (self.age % 1)*12 ),
-                                                                              days=-np.random.uniform(1,30))
+                                                                              days=-rng.uniform(1,30))
         else:
-            self.date_of_birth=None
+            self.date_of_birth=date_of_birth
 
         self.country=country
         self.mrr=None
 
         if satisfaction is None:
             age_contrib = 0.5* (Customer.AVG_AGE - self.age)/Customer.AGE_RANGE
-            self.satisfaction_propensity = np.power(2.0, np.random.uniform(-1.5, 1.5) + age_contrib)
+            self.satisfaction_propensity = np.power(2.0, rng.uniform(-1.5, 1.5) + age_contrib)
         else:
             self.satisfaction_propensity = satisfaction
-        self.subscriptions=[]
-        self.events=[]
+        self.subscription_start = ArrayBuffer('datetime64[D]')
+        self.subscription_end = ArrayBuffer('datetime64[D]')
+        self.subscription_mrr = ArrayBuffer(np.float64)
+        self.event_times = ArrayBuffer(np.int64)
+        self.event_types = ArrayBuffer(np.int16)
+        self.event_counts = ArrayBuffer(np.int64)
 
+    def add_subscription(self, start_date, end_date, mrr):
+        self.subscription_start.append(start_date)
+        self.subscription_end.append(end_date)
+        self.subscription_mrr.append(mrr)
+
+    @property
+    def subscriptions(self):
+        '''
+        :return: list of (start date, end date, mrr) tuples, made from the buffers on request
+        '''
+        return list(zip(self.subscription_start.values.tolist(), self.subscription_end.values.tolist(),
+                        self.subscription_mrr.values.tolist()))
 
-    def pick_plan(self,plans):
-        self.mrr = np.random.choice(plans['mrr'],p=plans['prob'])
+    @property
+    def events(self):
+        '''
+        :return: list of (event time, event index) tuples, made from the buffers on request
+        '''
+        return list(zip(self.event_times.values.astype('datetime64[s]').tolist(), self.event_types.values.tolist()))
 
 
-    def generate_events(self,start_date,end_date):
+    def pick_plan(self,plans,rng):
         '''
-        Generate a sequence of events at the customers daily rates.  Each count for an event on a day is droing from
-        a poisson distribution with the customers average rate.  If the number is greater than zero, that number of events
-        are created as tuples of time stamps and the event index (which is the database type id).  The time of the
-        event is randomly set to anything on the 24 hour range.
+        :param plans: the plans table or a CategoricalSampler of the plan mrr
+        :param rng: np.random.Generator
+        '''
+        if isinstance(plans, CategoricalSampler):
+            self.mrr = plans.sample(1, rng)[0]
+        else:
+            self.mrr = rng.choice(plans['mrr'],p=plans['prob'])
+
+
+    def generate_events(self,start_date,end_date,calendar,rng,daily=False):
+        '''
+        Generate a sequence of events at the customers daily rates.  The count for each event type on each day is drawn
+        from a poisson distribution with the customers average rate, all (days x event types) counts in a single call,
+        and scaled by the multiplier of the day. The events are appended to the event buffers as time stamps and the
+        event index (which is the database type id).  The time of the event is randomly set to anything on the 24 hour
+        range.
         :param start_date: datetime.date for start of simulation
         :param end_date: datetime.date for end of simulation
-        :return: The total count of each event, the list of all of the event tuples
-        '''
-
-        delta = end_date - start_date
-
-        events=[]
-        counts=[0]*len(self.behave_per_day)
-        for i in range(delta.days):
-            the_date = start_date + timedelta(days=i)
-            if the_date in Customer.date_multipliers:
-                multiplier = Customer.date_multipliers[the_date]
-            else:
-                if the_date.weekday() >= 4:
-                    multiplier = np.random.uniform(1.00,1.2)
-                else:
-                    multiplier = np.random.uniform(0.825,1.025)
-                Customer.date_multipliers[the_date]=multiplier
-            for event_idx,rate in  enumerate(self.behave_per_day):
-                new_count= int(round(multiplier*np.random.poisson(rate)))
-                counts[event_idx] += new_count
-                for n in range(0,new_count):
-                    # event_time=datetime.combine(the_date,time(randrange(24),randrange(60),randrange(60)))
-                    event_time=datetime.combine(the_date,time(np.random.randint(24),np.random.randint(60),np.random.randint(60)))
-                    new_event=(event_time,event_idx)
-                    events.append(new_event )
-
-        self.events.extend(events)
-
-        return counts
\ No newline at end of file
+        :param calendar: the SimulationCalendar with the day multipliers of the simulation, shared by all customers
+        :param rng: np.random.Generator
+        :param daily: keep the number of events per day and event type instead of single time stamped events
+        :return: The total count of each event
+        '''
+
+        n_days = (end_date - start_date).days
+        multipliers = calendar.period(start_date, n_days)
+
+        rates = np.ravel(self.behave_per_day)
+        daily_counts = rng.poisson(rates, size=(n_days, len(rates)))
+        daily_counts = np.rint(multipliers[:, np.newaxis] * daily_counts).astype(np.int64)
+        counts = daily_counts.sum(axis=0)
+
+        if daily:
+            event_times, event_types, event_counts = event_day_counts(start_date, daily_counts)
+            self.event_counts.extend(event_counts)
+        else:
+            event_times, event_types = event_timestamps(start_date, daily_counts, rng)
+        self.event_times.extend(event_times)
+        self.event_types.extend(event_types)
+
+        return counts
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def event_timestamps(start_date, daily_counts, rng):
+    '''
+    Expands a (days x event types) matrix of event counts into single events. The events are ordered by day and
+    event type, the time of each event is drawn uniformly on the 24 hour range of its day.
+    :param start_date: datetime.date of the first row of daily_counts
+    :param daily_counts: ndarray of non negative integer counts, shape (days, event types)
+    :param rng: np.random.Generator
+    :return: int64 seconds since the epoch, event type index (both ndarrays of the same length)
+    '''
+    n_types = daily_counts.shape[1]
+    cells = np.repeat(np.arange(daily_counts.size), daily_counts.ravel())
+    day_index, event_types = np.divmod(cells, n_types)
+    start = np.datetime64(start_date, 's').astype(np.int64)
+    event_times = start + SECONDS_PER_DAY * day_index + rng.integers(SECONDS_PER_DAY, size=cells.size)
+    return event_times, event_types
+
+
+def event_day_counts(start_date, daily_counts):
+    '''
+    The days and event types with events of a (days x event types) matrix of event counts, for writing the counts
+    per day instead of single events.
+    :param start_date: datetime.date of the first row of daily_counts
+    :param daily_counts: ndarray of non negative integer counts, shape (days, event types)
+    :return: int64 seconds since the epoch of the start of the day, event type index, number of events
+    '''
+    cells = np.flatnonzero(daily_counts)
+    day_index, event_types = np.divmod(cells, daily_counts.shape[1])
+    start = np.datetime64(start_date, 's').astype(np.int64)
+    return start + SECONDS_PER_DAY * day_index, event_types, daily_counts.ravel()[cells]
+
+
+def add_months(dates, months):
+    '''
+    Vectorized version of `date + relativedelta(months=months)`: the day of month is kept and clipped to the last
+    day of the target month.
+    :param dates: ndarray of datetime64[D]
+    :param months: int or ndarray of ints (may be negative)
+    :return: ndarray of datetime64[D]
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    month_start = dates.astype('datetime64[M]')
+    day = dates - month_start.astype('datetime64[D]')
+    target = month_start + np.asarray(months).astype('timedelta64[M]')
+    last_day = (target + 1).astype('datetime64[D]') - target.astype('datetime64[D]') - 1
+    return target.astype('datetime64[D]') + np.minimum(day, last_day)
+
+
+class SimulationCalendar:
+    __slots__ = ('start', 'multipliers')
+
+    def __init__(self, start_date, n_days, seed=None):
+        '''
+        The activity multipliers of every day of a simulation, drawn once up front: weekends (Friday to Sunday) are
+        more active than weekdays. The calendar is only read during the simulation, so every customer (and every
+        worker process, which gets a copy) sees the same multipliers no matter in which order the customers are
+        simulated.
+        :param start_date: datetime.date of the first day
+        :param n_days: number of days
+        :param seed: seed (or np.random.Generator) of the multipliers
+        '''
+        self.start = np.datetime64(start_date, 'D')
+        weekday = (self.start.astype(np.int64) + np.arange(n_days) + 3) % 7  # 1970-01-01 was a Thursday
+        low = np.where(weekday >= 4, 1.0, 0.825)
+        self.multipliers = low + 0.2 * np.random.default_rng(seed).uniform(size=n_days)
+
+    def __len__(self):
+        return len(self.multipliers)
+
+    def day_offset(self, dates):
+        '''
+        :param dates: datetime.date or ndarray of datetime64[D]
+        :return: the number of days since the start of the calendar
+        '''
+        return (np.asarray(dates, dtype='datetime64[D]') - self.start).astype(np.int64)
+
+    def period(self, start_date, n_days):
+        '''
+        :param start_date: datetime.date of the first day
+        :param n_days: number of days
+        :return: ndarray view of the multipliers of n_days consecutive days starting at start_date
+        '''
+        first = int(self.day_offset(start_date))
+        if first < 0 or first + n_days > len(self):
+            raise ValueError(f"the period of {n_days} days from {start_date} is outside of the simulation calendar")
+        return self.multipliers[first:first + n_days]
+
+
+class CategoricalSampler:
+    __slots__ = ('values', 'cdf')
+
+    def __init__(self, values, p):
+        '''
+        Draws from a categorical distribution with the cumulative probabilities precomputed: a batch of draws is one
+        searchsorted of uniform numbers. The draws are the same as those of Generator.choice(values, p=p) with the
+        same generator state, only the validation and normalization are done once.
+        :param values: the categories
+        :param p: their probabilities
+        '''
+        p = np.asarray(p, dtype=float)
+        if len(p) != len(values) or np.any(p < 0) or not np.isclose(p.sum(), 1.0):
+            raise ValueError("the probabilities must be non-negative, sum to 1 and match the values")
+        self.values = np.asarray(values)
+        self.cdf = np.cumsum(p)
+        self.cdf /= self.cdf[-1]
+
+    def codes(self, size, rng):
+        '''
+        :param size: number of draws
+        :param rng: np.random.Generator
+        :return: ndarray (size) of category indices
+        '''
+        return self.cdf.searchsorted(rng.random(size), side='right')
+
+    def sample(self, size, rng):
+        '''
+        :return: ndarray (size) of categories
+        '''
+        return self.values[self.codes(size, rng)]
+
+    def __len__(self):
+        return len(self.cdf)
+
+
+class CustomerBatch:
+
+    def __init__(self, behave_per_month, satisfaction, date_of_birth, channel, country=None, mrr=None):
+        '''
+        A batch of newly generated customers held as arrays (one row per customer) instead of Customer objects.
+        Single customers are only created when they are simulated, by indexing or iterating over the batch.
+        :param behave_per_month: ndarray (n x behaviors) of behavior rates PER MONTH
+        :param satisfaction: ndarray (n) of satisfaction propensities
+        :param date_of_birth: ndarray (n) of datetime64[D]
+        :param channel: ndarray (n) of channel names
+        :param country: ndarray (n) of countries, may be set later
+        :param mrr: ndarray (n) of the initial mrr, may be set later
+        '''
+        self.behave_per_month = behave_per_month
+        self.satisfaction = satisfaction
+        self.date_of_birth = date_of_birth
+        self.channel = channel
+        self.country = country
+        self.mrr = mrr
+
+    @classmethod
+    def generate(cls, behave_per_month, channel_name, start_of_month, rng):
+        '''
+        Draws ages, dates of birth and satisfaction propensities for all customers in one go, the same way a single
+        Customer does it in its constructor.
+        :param behave_per_month: ndarray (n x behaviors) of behavior rates PER MONTH
+        :param channel_name: the channel of all customers in the batch
+        :param start_of_month: datetime.date the customers are created for
+        :param rng: np.random.Generator
+        :return: a CustomerBatch
+        '''
+        n = behave_per_month.shape[0]
+        age = rng.uniform(Customer.MIN_AGE, Customer.MAX_AGE, size=n)
+        months_back = 12 * age.astype(np.int64) + ((age % 1) * 12).astype(np.int64)
+        days_back = np.ceil(rng.uniform(1, 30, size=n)).astype('timedelta64[D]')
+        start = np.full(n, start_of_month, dtype='datetime64[D]')
+        date_of_birth = add_months(start, -months_back) - days_back
+
+        age_contrib = 0.5 * (Customer.AVG_AGE - age) / Customer.AGE_RANGE
+        satisfaction = np.power(2.0, rng.uniform(-1.5, 1.5, size=n) + age_contrib)
+        channel = np.full(n, channel_name, dtype=object)
+        return cls(behave_per_month, satisfaction, date_of_birth, channel)
+
+    @classmethod
+    def concat(cls, batches):
+        columns = {}
+        for field in ('behave_per_month', 'satisfaction', 'date_of_birth', 'channel', 'country', 'mrr'):
+            values = [getattr(batch, field) for batch in batches]
+            columns[field] = None if any(v is None for v in values) else np.concatenate(values)
+        return cls(**columns)
+
+    def take(self, index):
+        '''
+        :param index: integer index array
+        :return: a new CustomerBatch with the selected rows
+        '''
+        return CustomerBatch(self.behave_per_month[index], self.satisfaction[index], self.date_of_birth[index],
+                             self.channel[index],
+                             None if self.country is None else self.country[index],
+                             None if self.mrr is None else self.mrr[index])
+
+    def __len__(self):
+        return self.behave_per_month.shape[0]
+
+    def __getitem__(self, i):
+        customer = Customer(self.behave_per_month[i], satisfaction=self.satisfaction[i],
+                            channel_name=self.channel[i], date_of_birth=self.date_of_birth[i].item(),
+                            country=None if self.country is None else self.country[i])
+        if self.mrr is not None:
+            customer.mrr = self.mrr[i]
+        return customer
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
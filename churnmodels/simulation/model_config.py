@@ -0,0 +1,165 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from churnmodels import conf
+from churnmodels.simulation.behavior2 import FatTailledBehaviorModel
+from churnmodels.simulation.utility2 import UtilityModel
+
+# the csv files of a model that are not behavior models
+MODEL_TABLES = ('utility', 'population', 'country', 'plans')
+# bump when the content of the bundles changes, old bundles are not read any more
+BUNDLE_FORMAT = 1
+
+# the configs loaded by this process, by model name and digest of the csv files
+_loaded = {}
+
+
+def source_digest(model_name):
+    '''
+    :param model_name: name of the model
+    :return: hex digest of the names and contents of all csv files of the model
+    '''
+    digest = hashlib.sha1(f"format {BUNDLE_FORMAT}".encode())
+    for version, filename in sorted(conf.get_files(model_name).items()):
+        digest.update(version.encode())
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_folder():
+    '''
+    :return: the folder of the compiled bundles, CHURN_CONF_CACHE or the __pycache__ of the conf folder
+    '''
+    return os.getenv("CHURN_CONF_CACHE") or os.path.join(conf.folder, "__pycache__")
+
+
+class ModelConfig:
+
+    def __init__(self, model_name, arrays):
+        '''
+        The parameters of a model compiled into arrays: for every behavior model the means, the scaled covariance,
+        the log means and the covariance factor, the linear utilities, the plans, countries and population percents.
+        The arrays are validated and precomputed once (see compile) and cached in an .npz bundle keyed by the
+        digest of the csv files, simulations (and their worker processes) build their models from the arrays.
+        :param model_name: name of the model
+        :param arrays: dict of name -> ndarray, as written by save
+        '''
+        self.model_name = model_name
+        self.arrays = arrays
+
+    @classmethod
+    def compile(cls, model_name):
+        '''
+        Reads the csv files of a model and precomputes the behavior models the way FatTailledBehaviorModel does.
+        :param model_name: name of the model
+        :return: ModelConfig
+        '''
+        files = conf.get_files(model_name)
+        # the behavior models in the order of the files, as the simulation always took them
+        versions = [version for version in files if version not in MODEL_TABLES]
+        arrays = {'versions': np.array(versions)}
+        for version in versions:
+            model = FatTailledBehaviorModel(model_name, None, version)
+            arrays[version + '.behave_names'] = np.asarray(model.behave_names, dtype=str)
+            arrays[version + '.behave_means'] = np.asarray(model.behave_means, dtype=float)
+            arrays[version + '.behave_cov'] = np.asarray(model.behave_cov, dtype=float)
+            arrays[version + '.log_means'] = np.asarray(model.log_means, dtype=float)
+            arrays[version + '.cov_factor'] = model.cov_factor
+
+        utility = conf.get_csv(model_name, 'utility')
+        arrays['utility.behavior'] = utility.iloc[:, 0].to_numpy(dtype=str)
+        arrays['utility.util'] = utility['util'].to_numpy(dtype=float)
+        plans = conf.get_csv(model_name, 'plans')
+        arrays['plans.plan'] = plans['plan'].to_numpy(dtype=str)
+        arrays['plans.mrr'] = plans['mrr'].to_numpy(dtype=float)
+        arrays['plans.prob'] = plans['prob'].to_numpy(dtype=float)
+        country = conf.get_csv(model_name, 'country')
+        arrays['country.country'] = country['country'].to_numpy(dtype=str)
+        arrays['country.pcnt'] = country['pcnt'].to_numpy(dtype=float)
+        if 'population' in files:
+            population = conf.get_csv(model_name, 'population')
+            arrays['population.version'] = population.iloc[:, 0].to_numpy(dtype=str)
+            arrays['population.pcnt'] = population['pcnt'].to_numpy(dtype=float)
+        return cls(model_name, arrays)
+
+    @classmethod
+    def load(cls, model_name):
+        '''
+        The compiled config of a model: from the configs loaded by this process, from the bundle in the cache
+        folder or compiled from the csv files (and saved as bundle). A changed csv file changes the digest, the old
+        bundle is not used then.
+        :param model_name: name of the model
+        :return: ModelConfig
+        '''
+        digest = source_digest(model_name)
+        key = (model_name, digest)
+        if key not in _loaded:
+            path = os.path.join(cache_folder(), f"{model_name}.{digest}.npz")
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    config = cls(model_name, {name: data[name] for name in data.files})
+            else:
+                config = cls.compile(model_name)
+                try:
+                    config.save(path)
+                except OSError:
+                    # a read only installation compiles in every process
+                    pass
+            _loaded[key] = config
+        return _loaded[key]
+
+    def save(self, path):
+        '''
+        Writes the bundle, the file is replaced atomically.
+        :param path: file name
+        :return:
+        '''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **self.arrays)
+        os.replace(tmp_path, path)
+
+    @property
+    def versions(self):
+        return [str(version) for version in self.arrays['versions']]
+
+    def behavior_model(self, version, random_seed=None):
+        '''
+        :param version: name of the behavior model
+        :param random_seed: seed of the generator of the model
+        :return: FatTailledBehaviorModel
+        '''
+        return FatTailledBehaviorModel.from_arrays(
+            self.model_name, version, self.arrays[version + '.behave_names'], self.arrays[version + '.behave_means'],
+            self.arrays[version + '.behave_cov'], self.arrays[version + '.log_means'],
+            self.arrays[version + '.cov_factor'], random_seed)
+
+    def utility_model(self):
+        '''
+        :return: UtilityModel (the churn scale is not set)
+        '''
+        df = pd.DataFrame({'util': self.arrays['utility.util']},
+                          index=pd.Index(self.arrays['utility.behavior'].astype(object), name='behavior'))
+        return UtilityModel(self.model_name, df)
+
+    def plans(self):
+        return pd.DataFrame({'plan': self.arrays['plans.plan'].astype(object), 'mrr': self.arrays['plans.mrr'],
+                             'prob': self.arrays['plans.prob']})
+
+    def country(self):
+        return pd.DataFrame({'country': self.arrays['country.country'].astype(object),
+                             'pcnt': self.arrays['country.pcnt']})
+
+    def population(self):
+        '''
+        :return: DataFrame of the population percents indexed by behavior model, None for a model without
+        '''
+        if 'population.pcnt' not in self.arrays:
+            return None
+        return pd.DataFrame({'pcnt': self.arrays['population.pcnt']},
+                            index=pd.Index(self.arrays['population.version'].astype(object), name='population'))
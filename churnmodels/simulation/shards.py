@@ -0,0 +1,161 @@
+import os
+
+from sqlalchemy import create_engine, event
+
+from churnmodels.schema import Account, Subscription, Event, EventDaily
+from churnmodels.simulation.writer import next_ids, reserve_ids
+
+# the tables written by the simulation, the ids of all but account are local to a shard
+SHARD_TABLES = ("account", "subscription", "event", "event_daily")
+# the default SQLITE_MAX_ATTACHED, attach_shard_views attaches all shards to every connection
+MAX_SHARD_VIEWS = 10
+
+
+def shard_files(database, n_shards):
+    '''
+    :param database: file name of the target SQLite database
+    :param n_shards: number of shards
+    :return: the file names of the shards of the database
+    '''
+    return [f"{database}.shard{k}" for k in range(n_shards)]
+
+
+def create_shards(files):
+    '''
+    Creates empty shard databases with the simulation tables (old shard files are removed).
+    :param files: file names of the shards
+    :return:
+    '''
+    tables = [table.__table__ for table in (Account, Subscription, Event, EventDaily)]
+    for path in files:
+        if os.path.exists(path):
+            os.remove(path)
+        engine = create_engine(f"sqlite:///{path}")
+        # not create_tables, it binds the metadata to the engine
+        tables[0].metadata.create_all(engine, tables=tables)
+        engine.dispose()
+
+
+def shard_engine(path):
+    '''
+    An engine for writing a shard: a shard is scratch data until it is merged, so it is written without journal
+    and synchronous writes.
+    :param path: file name of the shard
+    :return: db engine object
+    '''
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def shard_settings(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA journal_mode=OFF")
+        dbapi_connection.execute("PRAGMA synchronous=OFF")
+
+    return engine
+
+
+def shard_offsets(engine, shard_ids, reserve=True):
+    '''
+    The account ids of the shards are disjoint ranges reserved in the target by the simulation, the subscription,
+    event and event_daily ids count from 1 in every shard. In the merged tables every shard gets an id range
+    reserved in the target.
+    :param engine: db engine object of the target database
+    :param shard_ids: the next (subscription, event, event_daily) id of every shard, as tracked by the simulation
+        writing the shards
+    :param reserve: reserve the ranges, otherwise the offsets are computed from the next free ids without reserving
+        them (for reading only)
+    :return: list of (table name -> id offset) for every shard
+    '''
+    offsets = []
+    next_id = next_ids(engine)
+    for ids in shard_ids:
+        counts = [0] + [first_free - 1 for first_free in ids]
+        first_ids = reserve_ids(engine, counts) if reserve else next_id
+        offsets.append({table: 0 if table == "account" else first_id - 1
+                        for table, first_id in zip(SHARD_TABLES, first_ids)})
+        next_id = [first_id + n for first_id, n in zip(first_ids, counts)]
+    return offsets
+
+
+def _shard_select(alias, table, columns, offset):
+    fields = ", ".join(f"id + {offset} AS id" if column == "id" else column for column in columns)
+    return f"SELECT {fields} FROM {alias}.{table}"
+
+
+def _columns(connection, table):
+    return [row[1] for row in connection.execute(f"PRAGMA main.table_info({table})").fetchall()]
+
+
+def _check_sqlite_file(engine):
+    if engine.dialect.name != "sqlite" or engine.url.database in (None, "", ":memory:"):
+        raise ValueError("shards can only be merged into an SQLite database file")
+
+
+def merge_shards(engine, files, shard_ids, remove=True):
+    '''
+    Copies the shards into the target database: every shard is ATTACHed to the connection in turn and its tables are
+    appended with INSERT INTO ... SELECT, the ids shifted by the shard_offsets. The copy runs within SQLite, the
+    rows never pass through python.
+    :param engine: db engine object of the target SQLite database
+    :param files: file names of the shards
+    :param shard_ids: the next (subscription, event, event_daily) id of every shard (see shard_offsets)
+    :param remove: delete the shard files after the merge
+    :return:
+    '''
+    _check_sqlite_file(engine)
+    offsets = shard_offsets(engine, shard_ids)
+    connection = engine.raw_connection()
+    try:
+        columns = {table: _columns(connection, table) for table in SHARD_TABLES}
+        for path, offset in zip(files, offsets):
+            # ATTACH and DETACH are not allowed within a transaction
+            connection.execute("ATTACH DATABASE ? AS shard", (path,))
+            try:
+                for table in SHARD_TABLES:
+                    connection.execute(f"INSERT INTO main.{table} ({', '.join(columns[table])}) "
+                                       + _shard_select("shard", table, columns[table], offset[table]))
+                connection.commit()
+            finally:
+                connection.execute("DETACH DATABASE shard")
+    finally:
+        connection.close()
+    if remove:
+        for path in files:
+            os.remove(path)
+
+
+def attach_shard_views(engine, files, shard_ids):
+    '''
+    Exposes the shards without copying them: every connection of the engine ATTACHes the shards and gets TEMP views
+    named like the simulation tables, the UNION ALL of the target table and the tables of all shards (with the ids
+    shifted behind the free ids of the target, they are not reserved). The temp views hide the tables of the main
+    database for unqualified names, so the queries on the engine read the simulated data as if merged.
+    SQLite allows 10 attached databases by default, so there are at most 10 shards (MAX_SHARD_VIEWS).
+    :param engine: db engine object of the target SQLite database
+    :param files: file names of the shards
+    :param shard_ids: the next (subscription, event, event_daily) id of every shard (see shard_offsets)
+    :return: the engine
+    '''
+    _check_sqlite_file(engine)
+    if len(files) > MAX_SHARD_VIEWS:
+        raise ValueError(f"at most {MAX_SHARD_VIEWS} shards can be attached, not {len(files)}")
+    offsets = shard_offsets(engine, shard_ids, reserve=False)
+    connection = engine.raw_connection()
+    try:
+        columns = {table: _columns(connection, table) for table in SHARD_TABLES}
+    finally:
+        connection.close()
+    views = [f"CREATE TEMP VIEW {table} AS " + " UNION ALL ".join(
+        [_shard_select("main", table, columns[table], 0)]
+        + [_shard_select(f"shard{k}", table, columns[table], offset[table]) for k, offset in enumerate(offsets)])
+             for table in SHARD_TABLES]
+
+    @event.listens_for(engine, "connect")
+    def attach_shards(dbapi_connection, connection_record):
+        for k, path in enumerate(files):
+            dbapi_connection.execute("ATTACH DATABASE ? AS ?", (path, f"shard{k}"))
+        for sql in views:
+            dbapi_connection.execute(sql)
+
+    # pooled connections do not have the views
+    engine.dispose()
+    return engine
@@ -0,0 +1,192 @@
+import concurrent.futures
+import itertools
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from churnmodels.simulation.churnsim2 import ChurnSimulation
+from churnmodels.simulation.cohort import CohortEngine
+
+# the scenario parameters apply_scenario knows
+SCENARIO_KEYS = ('monthly_growth_rate', 'init_customers', 'seed', 'utility', 'plan_prob', 'offset', 'kappa',
+                 'target_churn_rate')
+
+
+class KpiCollector:
+
+    def __init__(self, start_date, end_date):
+        '''
+        Takes the place of the CohortWriter of a cohort simulation: instead of writing the cohorts it keeps the
+        subscriptions of the last step and computes the churn KPIs of every step from two consecutive steps. Every
+        active customer has one subscription per step, a customer of one step missing in the next has churned. The
+        customers cut off by the end date (period ending after it) did not churn and are left out.
+        :param start_date: datetime.date start of the simulation, step i is the month i after it
+        :param end_date: datetime.date end of the simulation
+        '''
+        self.start_date = start_date
+        self.end = np.datetime64(end_date, 'D')
+        self.previous = None
+        self.rows = []
+
+    def put(self, cohort):
+        subscriptions = cohort.subscriptions
+        if self.previous is not None:
+            self.rows.append(self.kpis(self.previous, subscriptions))
+        self.previous = subscriptions
+
+    def flush(self):
+        pass
+
+    def kpis(self, previous, current):
+        '''
+        :param previous: subscription columns of a step
+        :param current: subscription columns of the next step
+        :return: dict of the KPIs of the previous step
+        '''
+        eligible = previous['end_date'] <= self.end
+        account = previous['account_index'][eligible]
+        mrr = previous['mrr'][eligible]
+        # the active customers keep their order from step to step
+        _, stay, next_index = np.intersect1d(account, current['account_index'], assume_unique=True,
+                                             return_indices=True)
+        next_mrr = current['mrr'][next_index]
+        n, n_stay = len(account), len(stay)
+        total_mrr = mrr.sum()
+        return {
+            'month': self.start_date + relativedelta(months=len(self.rows)),
+            'subscribers': n,
+            'mrr': total_mrr,
+            'churn_rate': (n - n_stay) / n if n else np.nan,
+            'mrr_churn_rate': 1.0 - mrr[stay].sum() / total_mrr if n else np.nan,
+            'net_retention': next_mrr.sum() / total_mrr if n else np.nan,
+            'upgrade_rate': np.count_nonzero(next_mrr > mrr[stay]) / n_stay if n_stay else np.nan,
+            'downgrade_rate': np.count_nonzero(next_mrr < mrr[stay]) / n_stay if n_stay else np.nan,
+        }
+
+    def result(self):
+        '''
+        :return: DataFrame with one row of KPIs per month (the steps with customers not cut off)
+        '''
+        rows = list(self.rows)
+        if self.previous is not None:
+            # nobody is active after the last step
+            rows.append(self.kpis(self.previous, {'account_index': np.empty(0, dtype=np.int64),
+                                                  'mrr': np.empty(0)}))
+        return pd.DataFrame(rows).query('subscribers > 0').set_index('month')
+
+
+def parameter_grid(**axes):
+    '''
+    All combinations of the parameter values, e.g.
+        parameter_grid(monthly_growth_rate=[0.05, 0.1], offset=[0.0, 0.5])
+    :param axes: parameter name -> list of values
+    :return: list of scenario dicts
+    '''
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def apply_scenario(sim, scenario):
+    '''
+    Sets the parameters of a scenario on a simulation:
+    - monthly_growth_rate, init_customers: the growth of the customer base
+    - utility: dict behavior name -> linear utility (the util column of the *_utility.csv), the churn scale is set
+      again
+    - plan_prob: the probabilities of the plans for new customers (the prob column of the *_plans.csv)
+    - offset, kappa: the churn sigmoid of the utility model, replacing the ones of setChurnScale
+    - target_churn_rate: calibrate the offset to this churn rate (with the kappa of the scenario, see
+      calibrate_churn)
+    The seed is taken by the ChurnSimulation.
+    :param sim: ChurnSimulation
+    :param scenario: dict of parameters
+    :return:
+    '''
+    unknown = set(scenario) - set(SCENARIO_KEYS)
+    if unknown:
+        raise ValueError(f"unknown scenario parameters {sorted(unknown)}")
+    if 'target_churn_rate' in scenario and 'offset' in scenario:
+        raise ValueError("a scenario sets either the target_churn_rate or the offset")
+    util_mod = sim.util_mod
+    for key in ('monthly_growth_rate', 'init_customers'):
+        if key in scenario:
+            setattr(sim, key, scenario[key])
+    if 'utility' in scenario:
+        unknown = set(scenario['utility']) - set(util_mod.behave_names)
+        if unknown:
+            raise ValueError(f"unknown behaviors {sorted(unknown)} in the utility of the scenario")
+        linear_utility = util_mod.linear_utility.copy()
+        linear_utility.update(pd.Series(scenario['utility'], dtype=float))
+        util_mod.linear_utility = linear_utility
+        util_mod.setChurnScale(sim.behavior_models, sim.population_percents)
+    if 'plan_prob' in scenario:
+        sim.plans = sim.plans.assign(prob=np.asarray(scenario['plan_prob'], dtype=float))
+        sim.set_samplers()
+    if 'target_churn_rate' in scenario:
+        sim.calibrate_churn(scenario['target_churn_rate'], kappa=scenario.get('kappa'))
+    for key in ('offset', 'kappa'):
+        if key in scenario:
+            setattr(util_mod, key, scenario[key])
+
+
+def simulate_scenario(model, start, end, init_customers, seed, scenario):
+    '''
+    Runs the cohort simulation of a scenario in memory: only the event counts are drawn, nothing is written.
+    :return: DataFrame of the monthly KPIs (see KpiCollector)
+    '''
+    sim = ChurnSimulation(model, start, end, scenario.get('init_customers', init_customers),
+                          scenario.get('seed', seed), None)
+    apply_scenario(sim, scenario)
+    sim.writer = KpiCollector(start, end)
+    CohortEngine(sim, events=False, progress=False).run()
+    return sim.writer.result()
+
+
+def mean_kpis(monthly):
+    '''
+    :param monthly: DataFrame of monthly KPIs (see KpiCollector)
+    :return: Series with the mean subscribers and mrr and the rates averaged with the subscribers as weights (the
+        last month has few customers whose period ends before the end date)
+    '''
+    weights = monthly['subscribers']
+    means = monthly[['subscribers', 'mrr']].mean()
+    rates = monthly.drop(columns=['subscribers', 'mrr'])
+    return pd.concat([means, rates.mul(weights, axis=0).sum() / weights.sum()])
+
+
+def _simulate_scenario(args):
+    return simulate_scenario(*args)
+
+
+def sweep(scenarios, model, start, end, init_customers, seed, workers=1, monthly=False):
+    '''
+    Simulates many what-if scenarios of a model without database, in parallel in a process pool, and returns their
+    churn KPIs. All scenarios use the same seed (unless they set one), so their differences are not blurred by
+    different random draws.
+    :param scenarios: list of scenario dicts (see apply_scenario and parameter_grid)
+    :param model: name of the behavior/utility model parameters
+    :param start: start date for simulation
+    :param end: end date for simulation
+    :param init_customers: how many customers to create at start date
+    :param seed: random seed of the simulations
+    :param workers: number of worker processes
+    :param monthly: return the KPIs of every month instead of their mean per scenario (see mean_kpis)
+    :return: DataFrame indexed by scenario number (and month) with the scenario parameters and the KPIs subscribers,
+        mrr, churn_rate, mrr_churn_rate, net_retention, upgrade_rate and downgrade_rate
+    '''
+    tasks = [(model, start, end, init_customers, seed, scenario) for scenario in scenarios]
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_simulate_scenario, tasks))
+    else:
+        results = [_simulate_scenario(task) for task in tasks]
+
+    parameters = pd.DataFrame([{key: str(value) if isinstance(value, (dict, list, tuple)) else value
+                                for key, value in scenario.items()} for scenario in scenarios])
+    parameters.index.name = 'scenario'
+    if monthly:
+        kpis = pd.concat(results, keys=range(len(results)), names=['scenario', 'month'])
+    else:
+        kpis = pd.DataFrame([mean_kpis(result) for result in results])
+        kpis.index.name = 'scenario'
+    return parameters.join(kpis, how='right')
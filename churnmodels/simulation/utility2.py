@@ -2,6 +2,7 @@ from pandas import DataFrame
 
 from .utility import UtilityModel as UtilityModelBase
 from churnmodels import conf
+import numpy as np
 import pandas as pd
 
 
@@ -13,3 +14,140 @@ class UtilityModel(UtilityModelBase):
             df = df.set_index(df.columns[0])
         self.linear_utility = df['util']
         self.behave_names = df.index.values
+        self.plan_mrr = None
+        self.plan_index = None
+
+    def set_plans(self, plans):
+        '''
+        Precompiles the plans table into lookup arrays: plan_mrr[i] is the mrr of plan i (plans ordered as in the
+        table, upgrades go to i+1) and plan_index maps an mrr to its plan.
+        :param plans: DataFrame with column 'mrr'
+        :return:
+        '''
+        self.plan_mrr = plans['mrr'].to_numpy(dtype=float)
+        self.plan_index = {mrr: i for i, mrr in enumerate(self.plan_mrr)}
+
+    def plan_of(self, mrr):
+        '''
+        :param mrr: float or ndarray of mrr values
+        :return: the plan index (or an array of plan indices)
+        '''
+        if np.ndim(mrr) == 0:
+            return self.plan_index[float(mrr)]
+        return pd.Index(self.plan_mrr).get_indexer(mrr)
+
+    # the sigmoids take floats or arrays
+    def churn_probability(self, u):
+        return 1.0 - 1.0 / (1.0 + np.exp(self.kappa * u + self.offset))
+
+    def downgrade_probability(self, u):
+        return 1.0 - 1.0 / (1.0 + np.exp(self.kappa * u * 0.5 + self.offset + 0.5))
+
+    def uprade_probability(self, u):
+        return 1.0 / (1.0 + np.exp(self.kappa * u * 0.5 + self.offset + 7.5))
+
+    def calibrate_offset(self, simulated_churn, churn_rate, kappa=None, tol=1e-3, max_iter=30):
+        '''
+        Sets the offset of the churn sigmoid (and kappa, if given) so the churn rate of a simulation is the requested
+        churn rate. The simulated churn rate increases with the offset, so the offset is found by bisection.
+        :param simulated_churn: function without arguments returning the monthly churn rate of a simulation with the
+            current offset and kappa of this model
+        :param churn_rate: the requested monthly churn rate, between 0 and 1
+        :param kappa: new kappa of the churn sigmoid, by default kappa is kept
+        :param tol: tolerance of the churn rate
+        :param max_iter: maximum number of bisection steps
+        :return: the offset
+        '''
+        if not 0.0 < churn_rate < 1.0:
+            raise ValueError(f"the churn rate must be between 0 and 1, not {churn_rate}")
+        if kappa is not None:
+            self.kappa = kappa
+
+        def rate_at(offset):
+            self.offset = offset
+            return simulated_churn()
+
+        low, high = self.offset - 1.0, self.offset + 1.0
+        while rate_at(low) > churn_rate:
+            low -= 2.0 * (high - low)
+        while rate_at(high) < churn_rate:
+            high += 2.0 * (high - low)
+        # the simulated rate is not exactly monotone (the draws of a customer shift with the population), the offset
+        # closest to the churn rate is kept
+        best, best_error = None, np.inf
+        for _ in range(max_iter):
+            offset = 0.5 * (low + high)
+            rate = rate_at(offset)
+            if abs(rate - churn_rate) < best_error:
+                best, best_error = offset, abs(rate - churn_rate)
+            if best_error <= tol:
+                break
+            if rate < churn_rate:
+                low = offset
+            else:
+                high = offset
+        self.offset = best
+        return best
+
+    def simulate_churn(self, event_counts, customer, rng):
+        utility = self.utility_function(event_counts, customer)
+        return rng.uniform() < self.churn_probability(utility)
+
+    def simulate_upgrade_downgrade(self, event_counts, customer, plans, rng):
+        '''
+        Upgrade (or for the top plan downgrade) one customer, the plan is looked up in the precompiled plan arrays.
+        :param event_counts:
+        :param customer:
+        :param plans: the plans table, only used if set_plans was not called before
+        :param rng: np.random.Generator
+        :return:
+        '''
+        if self.plan_mrr is None:
+            self.set_plans(plans)
+        new_plan = self.upgrade_downgrade_batch(np.asarray(event_counts)[np.newaxis, :],
+                                                np.array([customer.satisfaction_propensity]),
+                                                np.array([self.plan_of(customer.mrr)]), rng=rng)[0]
+        customer.mrr = self.plan_mrr[new_plan]
+
+    def utility_batch(self, event_counts, satisfaction):
+        '''
+        utility_function for many customers at once
+        :param event_counts: ndarray (n x behaviors) of event counts
+        :param satisfaction: ndarray (n) of satisfaction propensities
+        :return: ndarray (n) of utilities
+        '''
+        contrib_ratios = event_counts / self.behave_means
+        utility = np.sum(self.expected_contributions * (1.0 - np.exp(-2.0 * contrib_ratios)), axis=1)
+        return utility * np.where(utility > 0.0, satisfaction, 1.0 / satisfaction)
+
+    def churn_batch(self, event_counts, satisfaction, rng, utility=None):
+        '''
+        simulate_churn for many customers at once
+        :param event_counts: ndarray (n x behaviors) of event counts
+        :param satisfaction: ndarray (n) of satisfaction propensities
+        :param rng: np.random.Generator
+        :param utility: the result of utility_batch, if it is known already
+        :return: boolean ndarray (n), True for the customers that churn
+        '''
+        if utility is None:
+            utility = self.utility_batch(event_counts, satisfaction)
+        return rng.uniform(size=len(utility)) < self.churn_probability(utility)
+
+    def upgrade_downgrade_batch(self, event_counts, satisfaction, plan, rng, utility=None):
+        '''
+        simulate_upgrade_downgrade for many customers at once: customers below the top plan may upgrade, customers
+        on the top plan may downgrade.
+        :param event_counts: ndarray (n x behaviors) of event counts
+        :param satisfaction: ndarray (n) of satisfaction propensities
+        :param plan: ndarray (n) of plan indices
+        :param rng: np.random.Generator
+        :param utility: the result of utility_batch, if it is known already
+        :return: ndarray (n) of the new plan indices
+        '''
+        if utility is None:
+            utility = self.utility_batch(event_counts, satisfaction)
+        draw = rng.uniform(size=len(plan))
+        top_plan = len(self.plan_mrr) - 1
+        up = (plan < top_plan) & (draw < self.uprade_probability(utility))
+        down = (plan == top_plan) & (plan > 0) & (draw < self.downgrade_probability(utility))
+        return plan + up - down
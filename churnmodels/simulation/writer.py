@@ -0,0 +1,571 @@
+import io
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, event, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from churnmodels.schema import Account, Subscription, Event, EventDaily, IdSequence, ensure_indexes, \
+    drop_churn_indexes
+
+# the tables whose ids are handed out by the id_sequence table, in the order of the id tuples
+ID_TABLES = (Account.__table__, Subscription.__table__, Event.__table__, EventDaily.__table__)
+
+
+class SimulatedCohort:
+
+    def __init__(self, accounts, subscriptions, events, account_base=0):
+        '''
+        The simulation result of a group of customers, held column wise as numpy arrays. Subscriptions and events
+        refer to their customer by the row number in accounts (account_index), the database ids are only assigned
+        when the cohort is written.
+        When the results of a run are written in several parts (as the cohort engine does month by month), the
+        account_index counts from the first account of the run and account_base is the index of the first account in
+        this part; subscriptions and events may then refer to accounts of earlier parts.
+        :param accounts: dict with channel, date_of_birth (datetime64[D]) and country
+        :param subscriptions: dict with account_index, start_date, end_date (datetime64[D]) and mrr
+        :param events: dict with account_index, event_time (int64 seconds since the epoch) and event_type (int16);
+            for daily event counts event_time is the start of the day and n the number of events
+        :param account_base: account_index of the first row in accounts
+        '''
+        self.accounts = accounts
+        self.subscriptions = subscriptions
+        self.events = events
+        self.account_base = account_base
+
+    @classmethod
+    def from_customers(cls, customers, daily=False):
+        '''
+        Collects the buffers of simulated Customer objects in one pass.
+        :param customers: list of Customer objects
+        :param daily: the customers have daily event counts
+        :return: a SimulatedCohort
+        '''
+        n_subscriptions = np.array([len(x.subscription_start) for x in customers], dtype=np.int64)
+        n_events = np.array([len(x.event_times) for x in customers], dtype=np.int64)
+        account_index = np.arange(len(customers), dtype=np.int64)
+
+        def concat(buffers, dtype):
+            return np.concatenate([b.values for b in buffers]) if buffers else np.empty(0, dtype=dtype)
+
+        accounts = {
+            'channel': np.array([x.channel for x in customers], dtype=object),
+            'date_of_birth': np.array([x.date_of_birth for x in customers], dtype='datetime64[D]'),
+            'country': np.array([x.country for x in customers], dtype=object),
+        }
+        subscriptions = {
+            'account_index': np.repeat(account_index, n_subscriptions),
+            'start_date': concat([x.subscription_start for x in customers], 'datetime64[D]'),
+            'end_date': concat([x.subscription_end for x in customers], 'datetime64[D]'),
+            'mrr': concat([x.subscription_mrr for x in customers], np.float64),
+        }
+        events = {
+            'account_index': np.repeat(account_index, n_events),
+            'event_time': concat([x.event_times for x in customers], np.int64),
+            'event_type': concat([x.event_types for x in customers], np.int16),
+        }
+        if daily:
+            events['n'] = concat([x.event_counts for x in customers], np.int64)
+        return cls(accounts, subscriptions, events)
+
+    @classmethod
+    def concat(cls, cohorts):
+        '''
+        Appends several cohorts, the account_index of the later cohorts is shifted accordingly.
+        :param cohorts: list of SimulatedCohort
+        :return: a SimulatedCohort
+        '''
+        offsets = np.cumsum([0] + [cohort.n_accounts for cohort in cohorts[:-1]])
+        tables = []
+        for table in ('accounts', 'subscriptions', 'events'):
+            columns = {}
+            for name in getattr(cohorts[0], table):
+                parts = [getattr(cohort, table)[name] for cohort in cohorts]
+                if name == 'account_index':
+                    parts = [part + offset for part, offset in zip(parts, offsets)]
+                columns[name] = np.concatenate(parts)
+            tables.append(columns)
+        return cls(*tables)
+
+    @property
+    def n_accounts(self):
+        return len(self.accounts['channel'])
+
+    @property
+    def n_subscriptions(self):
+        return len(self.subscriptions['account_index'])
+
+    @property
+    def n_events(self):
+        return len(self.events['account_index'])
+
+
+def _next_id(connection, table):
+    sequence = IdSequence.__table__
+    next_id = connection.execute(select([sequence.c.next_id]).where(sequence.c.name == table.name)).scalar()
+    if next_id is None:
+        # a table without sequence row yet (e.g. written before the id_sequence table existed) continues after its ids
+        next_id = (connection.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+        if connection.dialect.name in ("postgresql", "sqlite"):
+            # a concurrent writer may create the row first, then its next_id is taken
+            insert = postgresql.insert if connection.dialect.name == "postgresql" else sqlite.insert
+            connection.execute(insert(sequence).values(name=table.name, next_id=next_id).on_conflict_do_nothing())
+            next_id = connection.execute(select([sequence.c.next_id]).where(sequence.c.name == table.name)).scalar()
+        else:
+            connection.execute(sequence.insert().values(name=table.name, next_id=next_id))
+    return next_id
+
+
+def next_ids(engine):
+    '''
+    :return: the next free primary key of account, subscription, event and event_daily (the ids not reserved yet)
+    '''
+    with engine.begin() as connection:
+        return tuple(_next_id(connection, table) for table in ID_TABLES)
+
+
+def reserve_ids(engine, counts):
+    '''
+    Reserves contiguous id ranges of account, subscription, event and event_daily in the id_sequence table. The
+    ranges are handed out in one transaction, concurrent writers (threads, processes or loaders on other machines)
+    get disjoint ranges and insert without further coordination.
+    :param engine: db engine object
+    :param counts: (account, subscription, event, event_daily) number of ids to reserve
+    :return: the first id of each reserved range
+    '''
+    sequence = IdSequence.__table__
+    first_ids = []
+    with engine.begin() as connection:
+        for table, n in zip(ID_TABLES, counts):
+            # the update locks the row (Postgres) or the database (SQLite) until the commit
+            updated = connection.execute(sequence.update().where(sequence.c.name == table.name)
+                                         .values(next_id=sequence.c.next_id + int(n)))
+            if updated.rowcount == 0:
+                _next_id(connection, table)
+                connection.execute(sequence.update().where(sequence.c.name == table.name)
+                                   .values(next_id=sequence.c.next_id + int(n)))
+            first_ids.append(_next_id(connection, table) - int(n))
+    return tuple(first_ids)
+
+
+def reset_ids(connection, next_ids):
+    '''
+    Sets the next ids handed out, e.g. after deleting rows at the end of the tables.
+    :param connection: db connection within a transaction
+    :param next_ids: (account, subscription, event, event_daily) next id
+    '''
+    sequence = IdSequence.__table__
+    connection.execute(sequence.delete().where(sequence.c.name.in_([table.name for table in ID_TABLES])))
+    connection.execute(sequence.insert(), [{'name': table.name, 'next_id': int(next_id)}
+                                           for table, next_id in zip(ID_TABLES, next_ids)])
+
+
+def write_cohort(cohort, engine, options, first_ids=None):
+    '''
+    Writes a simulated cohort to the database. The primary keys are ranges reserved with reserve_ids (or by the
+    caller), the account ids of subscriptions and events are computed from their account_index: the first reserved
+    account id belongs to account_base, the accounts of the earlier cohorts of a run are the ids reserved before (a
+    run is the only writer of its tables, its account ranges follow each other). Each table is handed to load_table
+    as a dict of contiguous column arrays. Daily event counts go to the event_daily table instead of event.
+    :param cohort: a SimulatedCohort
+    :param engine: db engine object
+    :param options: dict with schema, product and bill_period_months
+    :param first_ids: (account, subscription, event, event_daily) ids of the first rows written, reserved by the
+        caller, by default they are reserved for the cohort
+    :return: the ids of the first account, subscription, event and event_daily row written
+    '''
+    if first_ids is None:
+        daily = 'n' in cohort.events
+        first_ids = reserve_ids(engine, (cohort.n_accounts, cohort.n_subscriptions, 0 if daily else cohort.n_events,
+                                         cohort.n_events if daily else 0))
+    next_account, first_subscription, first_event, first_daily = first_ids
+    # the account id of account_index 0
+    first_account = next_account - cohort.account_base
+
+    accounts = {'id': np.arange(cohort.n_accounts) + first_account + cohort.account_base}
+    accounts.update(cohort.accounts)
+    subscriptions = {
+        'id': np.arange(first_subscription, first_subscription + cohort.n_subscriptions),
+        'account_id': first_account + cohort.subscriptions['account_index'],
+        'product': np.full(cohort.n_subscriptions, options["product"], dtype=object),
+        'start_date': cohort.subscriptions['start_date'],
+        'end_date': cohort.subscriptions['end_date'],
+        'mrr': cohort.subscriptions['mrr'],
+        'bill_period_months': np.full(cohort.n_subscriptions, options["bill_period_months"], dtype=np.int64),
+    }
+    # the event type index starts at 0, the event_type_id at 1
+    if 'n' in cohort.events:
+        events_table = "event_daily"
+        events = {
+            'id': np.arange(first_daily, first_daily + cohort.n_events),
+            'account_id': first_account + cohort.events['account_index'],
+            'day': cohort.events['event_time'].astype('datetime64[s]').astype('datetime64[D]'),
+            'event_type_id': cohort.events['event_type'].astype(np.int64) + 1,
+            'n': cohort.events['n'],
+        }
+    else:
+        events_table = "event"
+        events = {
+            'id': np.arange(first_event, first_event + cohort.n_events),
+            'account_id': first_account + cohort.events['account_index'],
+            'event_time': cohort.events['event_time'].astype('datetime64[s]'),
+            'event_type_id': cohort.events['event_type'].astype(np.int64) + 1,
+        }
+
+    schema = options.get("schema")
+    load_table(engine, "account", accounts, schema)
+    load_table(engine, "subscription", subscriptions, schema)
+    load_table(engine, events_table, events, schema)
+    return first_account + cohort.account_base, first_subscription, first_event, first_daily
+
+
+def delete_rows_from(engine, first_ids, schema=None):
+    '''
+    Deletes the accounts, subscriptions, events and daily event counts with ids from the given ones on, e.g. the
+    rows written after a checkpoint by a run that did not finish. The ids are handed out again from there.
+    :param engine: db engine object
+    :param first_ids: (account, subscription, event, event_daily) first id to delete
+    :param schema: db schema or None
+    :return:
+    '''
+    with engine.begin() as connection:
+        # events and subscriptions before the accounts they refer to
+        for table_name, first_id in (("event", first_ids[2]), ("event_daily", first_ids[3]),
+                                     ("subscription", first_ids[1]), ("account", first_ids[0])):
+            target = table_name if schema is None else f"{schema}.{table_name}"
+            connection.exec_driver_sql(f"DELETE FROM {target} WHERE id >= {int(first_id)}")
+        reset_ids(connection, first_ids)
+
+
+class CohortWriter:
+
+    def __init__(self, engine, options, max_in_flight=4):
+        '''
+        Writes simulated cohorts in a background thread, so the simulation of the next customers overlaps with the
+        database writes. The cohorts are handed over in a bounded queue: put blocks while max_in_flight cohorts are
+        waiting, which caps the memory held by simulated but unwritten customers.
+        An in-memory SQLite database only exists for the connection of the thread that created it, for such an
+        engine the cohorts are written in the calling thread.
+        Use as a context manager, leaving it waits until every cohort is written.
+        :param engine: db engine object
+        :param options: dict with schema, product and bill_period_months (see write_cohort)
+        :param max_in_flight: maximum number of cohorts waiting to be written
+        '''
+        self.engine = engine
+        self.options = options
+        self.queue = queue.Queue(maxsize=max_in_flight)
+        self.thread = None
+        self.error = None
+
+    @property
+    def threaded(self):
+        url = self.engine.url
+        return not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"))
+
+    def __enter__(self):
+        if self.threaded:
+            self.thread = threading.Thread(target=self._drain, name="cohort-writer", daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, cohort):
+        '''
+        Queues a cohort for write_cohort, blocks while the queue is full.
+        :param cohort: a SimulatedCohort
+        '''
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            write_cohort(cohort, self.engine, self.options)
+        else:
+            self.queue.put(cohort)
+
+    def flush(self):
+        '''
+        Waits until all queued cohorts are written, a failed write is raised.
+        '''
+        if self.thread is not None:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        '''
+        Waits until all queued cohorts are written, a failed write is raised here (or by the next put).
+        '''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def _drain(self):
+        while True:
+            cohort = self.queue.get()
+            if cohort is None:
+                return
+            if self.error is None:
+                # after a failed write the remaining cohorts are only taken off the queue, so put does not block
+                try:
+                    write_cohort(cohort, self.engine, self.options)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+
+def load_table(engine, table_name, columns, schema=None, chunksize=100000):
+    '''
+    Appends the rows given as column arrays to a table. On Postgres the rows are streamed with COPY (see
+    copy_table), on SQLite they are inserted with executemany (see insert_rows), for all other dialects they are
+    inserted in blocks of chunksize rows (by the help of pandas).
+    :param engine: db engine object
+    :param table_name: name of the table
+    :param columns: dict of column name -> ndarray, all of the same length
+    :param schema: db schema or None
+    :param chunksize: number of rows per insert
+    :return:
+    '''
+    if engine.dialect.name == "postgresql":
+        copy_table(engine, table_name, columns, schema)
+        return
+    if engine.dialect.name == "sqlite":
+        insert_rows(engine, table_name, columns, schema)
+        return
+    df = pd.DataFrame({name: _db_values(values) for name, values in columns.items()})
+    db_opts = {"if_exists": "append", "index": False, "chunksize": chunksize}
+    if schema is not None:
+        db_opts["schema"] = schema
+    df.to_sql(table_name, engine, **db_opts)
+
+
+def copy_table(engine, table_name, columns, schema=None, batch_rows=1000000):
+    '''
+    Streams the rows into a Postgres table by `COPY ... FROM STDIN`: each batch of rows is rendered into an
+    in-memory buffer and handed to the psycopg2 cursor with copy_expert. Tables with fixed width columns only (like
+    event) use the binary COPY format, which is built from the arrays without formatting single values; tables with
+    text columns are rendered as csv. All batches are loaded in one transaction.
+    :param engine: db engine object (postgresql/psycopg2)
+    :param table_name: name of the table
+    :param columns: dict of column name -> ndarray, all of the same length
+    :param schema: db schema or None
+    :param batch_rows: number of rows per COPY
+    :return:
+    '''
+    target = table_name if schema is None else f"{schema}.{table_name}"
+    n_rows = len(next(iter(columns.values())))
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        binary_types = _binary_copy_types(cursor, table_name, schema, columns)
+        if binary_types is not None:
+            sql = f"COPY {target} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)"
+        else:
+            sql = f"COPY {target} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+            df = pd.DataFrame(columns)
+        for start in range(0, n_rows, batch_rows):
+            if binary_types is not None:
+                block = {name: values[start:start + batch_rows] for name, values in columns.items()}
+                buffer = io.BytesIO(_binary_copy_buffer(block, binary_types))
+            else:
+                buffer = io.StringIO()
+                df.iloc[start:start + batch_rows].to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# postgres data type -> (big endian numpy type of its binary COPY representation, numpy kinds of the arrays it takes)
+_PG_BINARY_TYPES = {
+    'smallint': ('>i2', 'iu'),
+    'integer': ('>i4', 'iu'),
+    'bigint': ('>i8', 'iu'),
+    'real': ('>f4', 'iuf'),
+    'double precision': ('>f8', 'iuf'),
+    'date': ('>i4', 'M'),  # days since 2000-01-01
+    'timestamp without time zone': ('>i8', 'M'),  # microseconds since 2000-01-01
+}
+_PG_EPOCH = np.datetime64('2000-01-01')
+
+
+def _binary_copy_types(cursor, table_name, schema, columns):
+    '''
+    The binary representation of every column, if all arrays fit their column: the kind of the array is one the
+    postgres type takes and integers are in the range of an integer column (the binary values would wrap around,
+    in csv Postgres rejects them). NaT is written as NULL.
+    :return: dict column name -> (postgres type, numpy type) if all columns can be copied in binary format, else None
+    '''
+    cursor.execute("select column_name, data_type from information_schema.columns "
+                   "where table_name = %s and table_schema = coalesce(%s, current_schema())", (table_name, schema))
+    db_types = dict(cursor.fetchall())
+    types = {}
+    for name, values in columns.items():
+        db_type = db_types.get(name)
+        if db_type not in _PG_BINARY_TYPES:
+            return None
+        np_type, kinds = _PG_BINARY_TYPES[db_type]
+        if values.dtype.kind not in kinds:
+            return None
+        if values.dtype.kind in 'iu' and np.dtype(np_type).kind == 'i' and len(values) > 0:
+            limits = np.iinfo(np_type)
+            if values.min() < limits.min or values.max() > limits.max:
+                return None
+        types[name] = (db_type, np_type)
+    return types
+
+
+def _binary_copy_buffer(columns, types):
+    '''
+    Builds the Postgres binary COPY data of the rows: every row is a field count followed by (length, value) per
+    field, which is written for all rows at once through a structured numpy array. A NULL (NaT) has length -1 and
+    no value, its value bytes are cut out of the array.
+    '''
+    n_rows = len(next(iter(columns.values())))
+    row_type = [('n_fields', '>i2')]
+    for i, (name, (db_type, np_type)) in enumerate(types.items()):
+        row_type += [(f'length{i}', '>i4'), (f'value{i}', np_type)]
+    rows = np.empty(n_rows, dtype=row_type)
+    rows['n_fields'] = len(types)
+    nulls = {}
+    for i, (name, (db_type, np_type)) in enumerate(types.items()):
+        values = columns[name]
+        length = np.dtype(np_type).itemsize
+        if values.dtype.kind == 'M' and np.isnat(values).any():
+            nulls[i] = np.isnat(values)
+            length = np.where(nulls[i], -1, length)
+        if db_type == 'date':
+            values = (values.astype('datetime64[D]') - _PG_EPOCH).astype(np.int64)
+        elif db_type.startswith('timestamp'):
+            values = (values.astype('datetime64[us]') - _PG_EPOCH).astype(np.int64)
+        rows[f'length{i}'] = length
+        rows[f'value{i}'] = values
+    header = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8  # signature, flags, header extension length
+    data = rows.view(np.uint8).reshape(n_rows, rows.dtype.itemsize)
+    if nulls:
+        keep = np.ones(data.shape, dtype=bool)
+        for i, null in nulls.items():
+            offset = rows.dtype.fields[f'value{i}'][1]
+            keep[null, offset:offset + rows.dtype[f'value{i}'].itemsize] = False
+        return header + data[keep].tobytes() + b'\xff\xff'
+    return header + data.tobytes() + b'\xff\xff'
+
+
+def _db_values(values):
+    # Date columns get python dates, otherwise pandas would store them as time stamps
+    if values.dtype == np.dtype('datetime64[D]'):
+        return values.astype(object)
+    return values
+
+
+def insert_rows(engine, table_name, columns, schema=None, batch_rows=500000):
+    '''
+    Inserts the rows into a SQLite table with executemany over one prepared INSERT statement, all batches in one
+    transaction. Dates and time stamps are passed as text in the format SQLAlchemy uses for SQLite.
+    :param engine: db engine object (sqlite)
+    :param table_name: name of the table
+    :param columns: dict of column name -> ndarray, all of the same length
+    :param schema: attached database name or None
+    :param batch_rows: number of rows per executemany
+    :return:
+    '''
+    target = table_name if schema is None else f"{schema}.{table_name}"
+    sql = f"INSERT INTO {target} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    n_rows = len(next(iter(columns.values())))
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for start in range(0, n_rows, batch_rows):
+            block = [_sqlite_values(values[start:start + batch_rows]) for values in columns.values()]
+            cursor.executemany(sql, zip(*block))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _sqlite_values(values):
+    if values.dtype == np.dtype('datetime64[D]'):
+        return np.datetime_as_string(values).tolist()
+    if values.dtype.kind == 'M':
+        # 'YYYY-MM-DD HH:MM:SS.ffffff' like sqlalchemy's DateTime: the 'T' at position 10 is replaced in place
+        text = np.datetime_as_string(values.astype('datetime64[us]'))
+        text.view('U1').reshape(len(text), -1)[:, 10] = ' '
+        return text.tolist()
+    return values.tolist()
+
+
+@contextmanager
+def bulk_load(engine, tables=("account", "subscription", "event", "event_daily"), journal_mode="OFF",
+              indexes=False):
+    '''
+    Bulk-load mode for SQLite files: within the with-block all new connections run with the given journal_mode
+    (OFF or WAL) and synchronous=OFF, and the secondary indexes of the tables are dropped. When the block is left the
+    indexes are created again and the connections are reset to the safe settings (rollback journal, synchronous
+    FULL). A crash during the load can leave the database corrupt, so this is meant for (re-)creating simulation
+    data. For other dialects and SQLite in memory only the churn indexes are handled (see indexes).
+
+        with bulk_load(engine):
+            write_cohort(cohort, engine, options)
+
+    :param engine: db engine object
+    :param tables: names of the tables that are loaded
+    :param journal_mode: "OFF" or "WAL"
+    :param indexes: build the churn indexes of the tables (see ensure_indexes) when the block is left; on other
+        dialects than SQLite the existing ones are dropped for the load
+    :return:
+    '''
+    if engine.dialect.name != "sqlite" or engine.url.database in (None, "", ":memory:"):
+        if indexes and engine.dialect.name != "sqlite":
+            drop_churn_indexes(engine, tables)
+        try:
+            yield engine
+        finally:
+            if indexes:
+                ensure_indexes(engine, tables)
+        return
+
+    def bulk_settings(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        dbapi_connection.execute("PRAGMA synchronous=OFF")
+
+    dropped = drop_indexes(engine, tables)
+    event.listen(engine, "connect", bulk_settings)
+    # pooled connections still have the old settings
+    engine.dispose()
+    try:
+        yield engine
+    finally:
+        event.remove(engine, "connect", bulk_settings)
+        engine.dispose()
+        with engine.connect() as connection:
+            # WAL is persistent in the database file, the other settings are reset with the connection
+            connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+            for sql in dropped:
+                connection.exec_driver_sql(sql)
+        if indexes:
+            ensure_indexes(engine, tables)
+
+
+def drop_indexes(engine, tables):
+    '''
+    Drops the secondary indexes of SQLite tables (automatic indexes of primary keys and unique constraints stay).
+    :param engine: db engine object (sqlite)
+    :param tables: names of the tables
+    :return: list of the CREATE INDEX statements to restore them
+    '''
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            "SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+        indexes = [(name, sql) for name, tbl_name, sql in rows if tbl_name in tables]
+        for name, sql in indexes:
+            connection.exec_driver_sql(f'DROP INDEX "{name}"')
+    return [sql for name, sql in indexes]
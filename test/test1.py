@@ -9,10 +9,12 @@ from churnmodels.schema import get_schema_rfl, get_db_uri
 from churnmodels.simulation.utility2 import UtilityModel
 from churnmodels.simulation.behavior2 import FatTailledBehaviorModel
 from churnmodels.simulation import simulate, Customer
+from churnmodels.simulation.customer import SimulationCalendar
 from churnmodels import conf
 
 
-def simulate_customer(start_of_month, plans, model_list, population_percents, country_lookup: dict, util_mod, end_date):
+def simulate_customer(start_of_month, plans, model_list, population_percents, country_lookup: dict, util_mod, end_date,
+                      calendar):
     '''
     Simulate one customer collecting its events and subscriptions.
 
@@ -21,6 +23,7 @@ def simulate_customer(start_of_month, plans, model_list, population_percents, co
     the month, and the utility model determines if there is a churn based on the simulated event counts.
 
     :param start_of_month:
+    :param calendar: the SimulationCalendar of the simulation
     :return: the new customer object it contains the events and subscriptions
     '''
     # customer_model = self.pick_customer_model()
@@ -31,7 +34,8 @@ def simulate_customer(start_of_month, plans, model_list, population_percents, co
     customer_country = np.random.choice(list(country_lookup.keys()), p=list(country_lookup.values()))
     new_customer.country = customer_country
 
-    new_customer.pick_plan(plans)
+    # the draws of the customer come from the generator of its behavior model
+    new_customer.pick_plan(plans, customer_model.rng)
 
     # Pick a random start date for the subscription within the month
     end_range = start_of_month + relativedelta(months=+1)
@@ -41,11 +45,11 @@ def simulate_customer(start_of_month, plans, model_list, population_percents, co
     churned = False
     while not churned:
         next_month = this_month + relativedelta(months=1)
-        new_customer.subscriptions.append((this_month, next_month, new_customer.mrr))
-        month_count = new_customer.generate_events(this_month, next_month)
-        churned = util_mod.simulate_churn(month_count, new_customer) or next_month > end_date
+        new_customer.add_subscription(this_month, next_month, new_customer.mrr)
+        month_count = new_customer.generate_events(this_month, next_month, calendar, customer_model.rng)
+        churned = util_mod.simulate_churn(month_count, new_customer, customer_model.rng) or next_month > end_date
         if not churned:
-            util_mod.simulate_upgrade_downgrade(month_count, new_customer, plans)
+            util_mod.simulate_upgrade_downgrade(month_count, new_customer, plans, customer_model.rng)
             this_month = next_month
     return new_customer
 
@@ -117,12 +121,13 @@ def test2():
         "population_percents": population_percents,
         "country_lookup": country_lookup,
         "util_mod": util_mod,
-        "end_date": options["end"]
+        "end_date": options["end"],
+        "calendar": SimulationCalendar(options["start"], (options["end"] - options["start"]).days + 62, seed)
     }
     cust1 = simulate_customer(**parameter)
     print(cust1)
-    for key, val in cust1.__dict__.items():
-        print(f"{key}={val}")
+    for key in cust1.__slots__:
+        print(f"{key}={getattr(cust1, key, None)}")
     # print(model_files["utility"]["data"])
 
     pass
@@ -0,0 +1,53 @@
+from datetime import date
+
+import numpy as np
+
+from churnmodels.simulation.behavior2 import FatTailledBehaviorModel, covariance_factor
+
+NAMES = ["login", "post", "like"]
+LOG_MEANS = np.array([10.0, 8.0, 12.0])
+COV = np.array([[1.0, 0.5, 0.2],
+                [0.5, 2.0, -0.3],
+                [0.2, -0.3, 0.5]])
+
+
+def model_means():
+    return np.power(1.6, LOG_MEANS)
+
+
+def test_generate_customers():
+    # log rates far above the clipping, so the gaussian draws can be recovered from the rates
+    model = FatTailledBehaviorModel.from_arrays("test", "web", NAMES, model_means(), COV, LOG_MEANS,
+                                                covariance_factor(COV), random_seed=1)
+    batch = model.generate_customers(20000, date(2020, 1, 1))
+    assert batch.behave_per_month.shape == (20000, len(NAMES))
+    assert len(batch.satisfaction) == len(batch.date_of_birth) == 20000
+    assert (batch.channel == "web").all()
+    assert (batch.date_of_birth < np.datetime64("2020-01-01")).all()
+    assert (batch.behave_per_month > 1).all()
+    log_rates = model.log_fun(batch.behave_per_month + 0.667)
+    np.testing.assert_allclose(log_rates.mean(axis=0), LOG_MEANS, atol=0.05)
+    np.testing.assert_allclose(np.cov(log_rates, rowvar=False), COV, atol=0.06)
+
+
+def test_generate_customers_seeded():
+    model = FatTailledBehaviorModel.from_arrays("test", "web", NAMES, model_means(), COV, LOG_MEANS,
+                                                covariance_factor(COV))
+    first = model.generate_customers(10, date(2020, 1, 1), np.random.default_rng(3))
+    second = model.generate_customers(10, date(2020, 1, 1), np.random.default_rng(3))
+    np.testing.assert_array_equal(first.behave_per_month, second.behave_per_month)
+    np.testing.assert_array_equal(first.satisfaction, second.satisfaction)
+
+
+def test_covariance_factor():
+    # positive definite: the Cholesky factor
+    factor = covariance_factor(COV)
+    np.testing.assert_allclose(factor, np.linalg.cholesky(COV))
+    # positive semi-definite (a behavior without variance): a factor from the eigen decomposition
+    singular = np.array([[1.0, 1.0, 0.0], [1.0, 1.0, 0.0], [0.0, 0.0, 0.0]])
+    factor = covariance_factor(singular)
+    np.testing.assert_allclose(factor @ factor.T, singular, atol=1e-12)
+    # indefinite: the negative eigen values are dropped, the factor gives the nearest semi-definite matrix
+    indefinite = np.array([[1.0, 2.0], [2.0, 1.0]])
+    factor = covariance_factor(indefinite)
+    np.testing.assert_allclose(factor @ factor.T, 1.5 * np.ones((2, 2)), atol=1e-12)
@@ -0,0 +1,70 @@
+import sqlite3
+from datetime import date
+
+from sqlalchemy import create_engine
+
+from churnmodels.schema import create_tables, create_lookups
+from churnmodels.simulation.churnsim2 import ChurnSimulation
+
+MODEL = "biznet1"
+START = date(2020, 1, 1)
+TABLES = ("account", "subscription", "event")
+
+
+def run_cohort(database, end, checkpoint=None, resume=False):
+    '''
+    Runs a small cohort simulation into an SQLite file, the tables are created unless the run is resumed.
+    :return: dict of table name -> rows ordered by id
+    '''
+    engine = create_engine(f"sqlite:///{database}")
+    if not resume:
+        create_tables(engine)
+        create_lookups(engine, MODEL)
+    sim = ChurnSimulation(MODEL, START, end, 50, 5432, engine, checkpoint=checkpoint)
+    sim.run_simulation("cohort", resume)
+    engine.dispose()
+    connection = sqlite3.connect(database)
+    try:
+        return {table: connection.execute(f"SELECT * FROM {table} ORDER BY id").fetchall() for table in TABLES}
+    finally:
+        connection.close()
+
+
+def test_extended_run(tmp_path):
+    # a run extended from its checkpoint gives the data of a run to the later end date
+    checkpoint = str(tmp_path / "run.npz")
+    run_cohort(tmp_path / "extended.db", date(2020, 3, 1), checkpoint)
+    extended = run_cohort(tmp_path / "extended.db", date(2020, 5, 1), checkpoint, resume=True)
+    direct = run_cohort(tmp_path / "direct.db", date(2020, 5, 1))
+    for table in TABLES:
+        assert extended[table] == direct[table], table
+
+
+class Crash(Exception):
+    pass
+
+
+def test_resumed_run(tmp_path, monkeypatch):
+    # a run stopped after a month and resumed from its checkpoint gives the data of an uninterrupted run
+    end = date(2020, 4, 1)
+    full = run_cohort(tmp_path / "full.db", end)
+    save_checkpoint = ChurnSimulation.save_checkpoint
+    for month in range(2, 4):
+        calls = []
+
+        def crashing(sim, *args, **kwargs):
+            calls.append(month)
+            if len(calls) == month:
+                # the cohorts of the month are written, the checkpoint is not
+                sim.writer.flush()
+                raise Crash()
+            save_checkpoint(sim, *args, **kwargs)
+
+        checkpoint = str(tmp_path / f"crash{month}.npz")
+        monkeypatch.setattr(ChurnSimulation, "save_checkpoint", crashing)
+        try:
+            run_cohort(tmp_path / f"crash{month}.db", end, checkpoint)
+        except Crash:
+            pass
+        monkeypatch.setattr(ChurnSimulation, "save_checkpoint", save_checkpoint)
+        assert run_cohort(tmp_path / f"crash{month}.db", end, checkpoint, resume=True) == full, month
@@ -0,0 +1,44 @@
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import create_engine
+
+from churnmodels.schema import create_tables, create_lookups
+from churnmodels.simulation.churnsim2 import ChurnSimulation
+
+MODEL = "biznet1"
+START, END = date(2020, 1, 1), date(2020, 5, 1)
+
+
+def run_cohort(seed):
+    '''
+    Runs a small cohort simulation into an in-memory SQLite database.
+    :return: the simulation and a dict of table name -> rows ordered by id (dates as text)
+    '''
+    engine = create_engine("sqlite://")
+    create_tables(engine)
+    create_lookups(engine, MODEL)
+    sim = ChurnSimulation(MODEL, START, END, 40, seed, engine)
+    sim.run_simulation("cohort")
+    with engine.connect() as connection:
+        rows = {table: connection.exec_driver_sql(f"SELECT * FROM {table} ORDER BY id").fetchall()
+                for table in ("account", "subscription", "event")}
+    return sim, rows
+
+
+def test_reproducible():
+    sim, rows = run_cohort(1234)
+    assert all(rows.values())
+    assert run_cohort(1234)[1] == rows
+    assert run_cohort(4321)[1] != rows
+
+
+def test_monthly_cohorts():
+    # every account starts its first subscription in the month it signs up
+    sim, rows = run_cohort(1234)
+    first_start = {}
+    for _, account_id, _, start_date, *_ in rows["subscription"]:
+        first_start[account_id] = min(start_date, first_start.get(account_id, start_date))
+    assert len(first_start) == len(rows["account"])
+    signups = Counter(date.fromisoformat(start[:7] + "-01") for start in first_start.values())
+    assert sorted(signups.items()) == list(sim.monthly_cohort_sizes())
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from churnmodels.simulation.customer import CategoricalSampler
+
+
+class Uniforms:
+    '''
+    Stands in for the generator, with the uniform numbers given.
+    '''
+    def __init__(self, values):
+        self.values = np.array(values)
+
+    def random(self, size):
+        return self.values[:size]
+
+
+def test_frequencies():
+    p = [0.5, 0.3, 0.15, 0.05]
+    sampler = CategoricalSampler(["a", "b", "c", "d"], p)
+    draws = sampler.sample(200000, np.random.default_rng(1))
+    frequencies = [np.mean(draws == value) for value in "abcd"]
+    np.testing.assert_allclose(frequencies, p, atol=0.005)
+    # the draws of Generator.choice
+    np.testing.assert_array_equal(draws[:1000], np.random.default_rng(1).choice(["a", "b", "c", "d"], 1000, p=p))
+
+
+def test_inexact_sum():
+    # the probabilities of a csv file sum to 1 up to rounding, the last category still ends at 1
+    for p in ([0.1] * 10, [1 / 3] * 3, [0.2, 0.3, 0.5 + 1e-9], [0.2, 0.3, 0.5 - 1e-9]):
+        sampler = CategoricalSampler(np.arange(len(p)), p)
+        assert sampler.cdf[-1] == 1.0
+        assert sampler.codes(2, Uniforms([0.0, 1.0 - 1e-16])).tolist() == [0, len(p) - 1]
+
+
+def test_zero_probability():
+    sampler = CategoricalSampler(["a", "b", "c"], [0.0, 0.5, 0.5])
+    assert sampler.sample(3, Uniforms([0.0, 0.5, 1.0 - 1e-16])).tolist() == ["b", "c", "c"]
+    for p in ([0.0, 0.5, 0.5], [0.5, 0.0, 0.5], [0.5, 0.5, 0.0]):
+        draws = CategoricalSampler(["a", "b", "c"], p).sample(10000, np.random.default_rng(2))
+        assert not np.any(draws == "abc"[p.index(0.0)])
+
+
+def test_invalid_probabilities():
+    for values, p in ((["a", "b"], [0.5, 0.4]), (["a", "b"], [1.5, -0.5]), (["a", "b", "c"], [0.5, 0.5])):
+        with pytest.raises(ValueError):
+            CategoricalSampler(values, p)
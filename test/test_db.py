@@ -0,0 +1,151 @@
+import sqlite3
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from churnmodels.db import DBHelper
+from churnmodels.schema import create_tables, get_schema_rfl, ensure_indexes, drop_churn_indexes, INDEXES
+
+METRIC_NAMES = [(1, "logins"), (2, "posts"), (3, "never_measured"), (2, "posts_again")]
+WEEK1, WEEK2 = "2020-01-05 00:00:00", "2020-01-12 00:00:00"
+# account, metric time, metric name id, value: account 3 has only a NULL value of posts in its week, metric id 9
+# is not in metric_name
+METRICS = [
+    (1, WEEK1, 1, 3.0), (1, WEEK1, 2, 1.5), (1, WEEK2, 1, None), (1, WEEK2, 2, 2.0),
+    (2, WEEK1, 1, 0.0), (2, WEEK1, 9, 4.0), (2, WEEK2, 2, None), (2, WEEK2, 1, 1.0),
+    (3, WEEK2, 2, None), (4, WEEK2, 1, 2.5), (4, WEEK2, 1, 0.5),
+]
+OBSERVATIONS = [(1, "2020-01-06", False), (1, "2020-01-13", False), (2, "2020-01-13", True), (3, "2020-01-14", False),
+                (4, "2020-01-13", False)]
+SUBSCRIPTIONS = [(1, "2019-12-01", None), (2, "2019-12-01", "2020-01-01"), (3, "2020-01-01", None),
+                 (4, "2020-01-01", None)]
+
+
+def sqlite_helper(database):
+    '''
+    A DBHelper of an SQLite file with a few metrics. DBHelper itself loads the libsqlitefunctions extension, the
+    queries tested here do not need it.
+    '''
+    engine = create_engine(f"sqlite:///{database}")
+    create_tables(engine)
+    engine.dispose()
+    connection = sqlite3.connect(database)
+    connection.executemany("INSERT INTO metric_name (metric_name_id, metric_name) VALUES (?, ?)", METRIC_NAMES)
+    connection.executemany("INSERT INTO metric (account_id, metric_time, metric_name_id, metric_value) "
+                           "VALUES (?, ?, ?, ?)", METRICS)
+    connection.executemany("INSERT INTO observation (account_id, observation_date, is_churn) VALUES (?, ?, ?)",
+                           OBSERVATIONS)
+    connection.executemany("INSERT INTO subscription (account_id, product, start_date, end_date, mrr, "
+                           "bill_period_months) VALUES (?, 'basic', ?, ?, 10, 1)", SUBSCRIPTIONS)
+    connection.commit()
+    connection.close()
+
+    helper = object.__new__(DBHelper)
+    helper.T = get_schema_rfl({"dialect": "sqlite", "file": str(database)})
+    helper.engine = create_engine(f"sqlite:///{database}")
+    helper.session = sessionmaker(bind=helper.engine)()
+    helper.to_days = lambda some_date: func.julianday(some_date)
+    return helper
+
+
+def test_pivot_modes(tmp_path):
+    helper = sqlite_helper(tmp_path / "metrics.db")
+    for args in [(), ("2020-01-10", "2020-01-31")]:
+        sql = helper.get_dataset(*args)
+        numpy = helper.get_dataset(*args, pivot="numpy")
+        assert list(sql.columns) == ["is_churn", "logins", "posts", "never_measured", "posts_again"]
+        assert sql["never_measured"].dtype == "int64"
+        pd.testing.assert_frame_equal(sql, numpy)
+
+
+def test_streamed_results(tmp_path):
+    # parts of two accounts or one observation date, fetched two rows at a time
+    helper = sqlite_helper(tmp_path / "metrics.db")
+    dataset = helper.get_dataset()
+    for partition in ("observation_date", "account_id"):
+        parts = list(helper.iter_dataset(partition=partition, accounts=2, chunksize=2))
+        assert len(parts) > 1
+        streamed = pd.concat(parts)
+        if partition == "account_id":
+            streamed = streamed.sort_index(level="observation_date", sort_remaining=False, kind="stable")
+        pd.testing.assert_frame_equal(streamed, dataset)
+    active = helper.get_active_customers()
+    assert active["never_measured"].dtype == "int64"
+    pd.testing.assert_frame_equal(pd.concat(helper.iter_active_customers(accounts=2, chunksize=2)), active)
+
+
+def index_names(engine):
+    with engine.connect() as connection:
+        return {row[0] for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+
+
+def test_churn_indexes(tmp_path):
+    helper = sqlite_helper(tmp_path / "metrics.db")
+    engine = helper.engine
+    assert "ix_metric_account_time_name" not in helper.explain(helper.dataset_query())
+    # all tables exist, every index is created once
+    assert sorted(ensure_indexes(engine)) == sorted(INDEXES)
+    assert index_names(engine) == set(INDEXES)
+    assert ensure_indexes(engine) == []
+    plan = helper.explain(helper.dataset_query())
+    assert "USING COVERING INDEX ix_metric_account_time_name" in plan
+    assert "ix_observation_account_date" in plan
+    assert sorted(drop_churn_indexes(engine, tables=["metric"])) == ["ix_metric_account_time_name"]
+    assert index_names(engine) == set(INDEXES) - {"ix_metric_account_time_name"}
+    drop_churn_indexes(engine)
+    assert index_names(engine) == set()
+
+
+# account, day, event type id, number of events
+EVENT_TYPES = [(1, "login"), (2, "post")]
+EVENTS_DAILY = [(1, "2020-01-01", 1, 2), (1, "2020-01-10", 1, 3), (1, "2020-01-28", 1, 1), (1, "2020-02-04", 2, 5),
+                (2, "2020-01-15", 2, 4), (2, "2020-01-29", 1, 1)]
+
+
+def event_daily_helper(database):
+    helper = sqlite_helper(database)
+    connection = sqlite3.connect(database)
+    connection.executemany("INSERT INTO event_type (event_type_id, event_type_name) VALUES (?, ?)", EVENT_TYPES)
+    connection.executemany("INSERT INTO event_daily (account_id, day, event_type_id, n) VALUES (?, ?, ?, ?)",
+                           EVENTS_DAILY)
+    connection.executemany("INSERT INTO metric_name (metric_name_id, metric_name) VALUES (?, ?)",
+                           [(10, "login_per_month"), (11, "post_per_month")])
+    connection.commit()
+    connection.close()
+    return helper
+
+
+# the event_count_metrics of EVENTS_DAILY: windows of 28 days ending (exclusive) on 2020-01-29, 2020-02-05 and
+# 2020-02-12
+EVENT_COUNTS = [(1, 1, "login_per_month", 6, "2020-01-29"), (1, 1, "login_per_month", 4, "2020-02-05"),
+                (1, 1, "login_per_month", 1, "2020-02-12"), (1, 2, "post_per_month", 5, "2020-02-05"),
+                (1, 2, "post_per_month", 5, "2020-02-12"), (2, 1, "login_per_month", 1, "2020-02-05"),
+                (2, 1, "login_per_month", 1, "2020-02-12"), (2, 2, "post_per_month", 4, "2020-01-29"),
+                (2, 2, "post_per_month", 4, "2020-02-05"), (2, 2, "post_per_month", 4, "2020-02-12")]
+
+
+def test_event_count_metrics(tmp_path):
+    helper = event_daily_helper(tmp_path / "events.db")
+    rows = [tuple(row) for row in helper.event_count_metrics("2020-01-29", "2020-02-12").all()]
+    assert rows == EVENT_COUNTS
+    # one window of 7 days ending on 2020-01-29
+    rows = [tuple(row) for row in helper.event_count_metrics("2020-01-29", "2020-01-29", window_days=7).all()]
+    assert rows == [(1, 1, "login_per_month", 1, "2020-01-29")]
+
+    helper.insert_event_count_metrics("2020-01-29", "2020-02-12")
+    with helper.engine.connect() as connection:
+        metrics = connection.exec_driver_sql(
+            "SELECT account_id, metric_time, metric_name_id, metric_value FROM metric WHERE metric_name_id >= 10 "
+            "ORDER BY account_id, metric_name_id, metric_time").fetchall()
+    assert [tuple(row) for row in metrics] == [(account, time, event_type + 9, value)
+                                               for account, event_type, _, value, time in EVENT_COUNTS]
+
+
+def test_events_per_day(tmp_path):
+    helper = event_daily_helper(tmp_path / "events.db")
+    rows = [tuple(row) for row in helper.events_per_day("2020-01-10", "2020-01-29").all()]
+    assert rows == [("login", date(2020, 1, 10), 3), ("login", date(2020, 1, 28), 1), ("login", date(2020, 1, 29), 1),
+                    ("post", date(2020, 1, 15), 4)]
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+
+# the heavy dependencies an import must not load (measured in a fresh interpreter): the package and the
+# simulation package load their attributes on first use, the customer model needs numpy only
+NOT_LOADED = {
+    "churnmodels": {"numpy", "pandas", "sqlalchemy", "sqlparse"},
+    "churnmodels.simulation": {"numpy", "pandas", "sqlalchemy", "tqdm"},
+    "churnmodels.simulation.customer": {"pandas", "sqlalchemy", "scipy", "tqdm"},
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_modules(statement):
+    '''
+    Runs an import statement in a new python process.
+    :return: the names of the loaded modules
+    '''
+    code = f"""
+import json, sys
+{statement}
+print(json.dumps(sorted(sys.modules)))
+"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    return set(json.loads(output.splitlines()[-1]))
+
+
+def test_lazy_imports():
+    for module, heavy in NOT_LOADED.items():
+        loaded = {name.split(".")[0] for name in loaded_modules(f"import {module}")}
+        assert not heavy & loaded, f"import {module} loads {sorted(heavy & loaded)}"
+
+
+def test_lazy_dependencies():
+    # the simulation does not load the drivers of the legacy Postgres simulation
+    modules = loaded_modules("from churnmodels.simulation import ChurnSimulation")
+    assert not {"postgres", "psycopg2"} & modules
+
+
+def test_star_imports():
+    # the names a star import gave before the attributes were loaded lazily
+    namespace = {}
+    exec("from churnmodels import *", namespace)
+    assert {"schema", "DBHelper", "make_day_interval", "required_envvar", "days_between", "pretty_sql"} \
+        <= set(namespace)
+    namespace = {}
+    exec("from churnmodels.simulation import *", namespace)
+    assert {"ChurnSimulation", "ChurnSimulationBase", "simulate", "setup_all", "get_engine"} <= set(namespace)
+
+
+if __name__ == '__main__':
+    test_lazy_imports()
+    test_lazy_dependencies()
+    test_star_imports()
@@ -0,0 +1,74 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from churnmodels import conf
+from churnmodels.simulation import model_config
+from churnmodels.simulation.model_config import ModelConfig, source_digest
+
+MODEL = "biznet1"
+
+
+@pytest.fixture
+def model_folder(tmp_path, monkeypatch):
+    '''
+    A copy of the csv files of the model as conf folder, the bundles in their own cache folder and no configs loaded
+    by this process.
+    :return: the conf folder, the cache folder
+    '''
+    folder = tmp_path / "conf"
+    folder.mkdir()
+    for filename in glob.glob(os.path.join(conf.folder, f"{MODEL}_*.csv")):
+        shutil.copy(filename, folder)
+    monkeypatch.setattr(conf, "folder", str(folder))
+    monkeypatch.setenv("CHURN_CONF_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(model_config, "_loaded", {})
+    return folder, tmp_path / "cache"
+
+
+def assert_same_arrays(config, other):
+    assert sorted(config.arrays) == sorted(other.arrays)
+    for name, values in config.arrays.items():
+        np.testing.assert_array_equal(other.arrays[name], values, err_msg=name)
+
+
+def test_round_trip(model_folder, monkeypatch):
+    folder, cache = model_folder
+    compiled = ModelConfig.compile(MODEL)
+    config = ModelConfig.load(MODEL)
+    assert_same_arrays(compiled, config)
+    # the bundle is written to CHURN_CONF_CACHE, not next to the csv files
+    assert os.listdir(cache) == [f"{MODEL}.{source_digest(MODEL)}.npz"]
+    assert not os.path.exists(folder / "__pycache__")
+    # the process keeps the config
+    assert ModelConfig.load(MODEL) is config
+
+    # a new process reads the bundle instead of the csv files
+    monkeypatch.setattr(model_config, "_loaded", {})
+    monkeypatch.setattr(ModelConfig, "compile", None)
+    loaded = ModelConfig.load(MODEL)
+    assert_same_arrays(compiled, loaded)
+    assert loaded.versions == compiled.versions
+    for version in loaded.versions:
+        np.testing.assert_array_equal(loaded.behavior_model(version).behave_means,
+                                      compiled.behavior_model(version).behave_means)
+    assert loaded.utility_model().linear_utility.equals(compiled.utility_model().linear_utility)
+    assert loaded.plans().equals(compiled.plans())
+    assert loaded.country().equals(compiled.country())
+    assert loaded.population().equals(compiled.population())
+
+
+def test_changed_csv(model_folder):
+    folder, cache = model_folder
+    config = ModelConfig.load(MODEL)
+    utility_file = folder / f"{MODEL}_utility.csv"
+    utility_file.write_text(utility_file.read_text().replace("post,1", "post,2"))
+    changed = ModelConfig.load(MODEL)
+    assert changed is not config
+    assert changed.utility_model().linear_utility["post"] == 2.0
+    assert config.utility_model().linear_utility["post"] == 1.0
+    # the bundle of the old csv files stays, it is not read any more
+    assert len(os.listdir(cache)) == 2
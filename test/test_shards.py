@@ -0,0 +1,55 @@
+import os
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+
+from churnmodels.schema import create_tables, create_lookups
+from churnmodels.simulation.churnsim2 import ChurnSimulation
+
+MODEL = "biznet1"
+START, END = date(2020, 1, 1), date(2020, 4, 1)
+
+
+def run_customers(database, **options):
+    '''
+    Runs a small customer simulation into an SQLite file, in chunks of 10 customers so that every shard gets some.
+    :return: dict of table name -> sorted rows, subscriptions and events without their ids (they are numbered in
+        another order when sharded), and the number of distinct ids of every table
+    '''
+    engine = create_engine(f"sqlite:///{database}")
+    create_tables(engine)
+    create_lookups(engine, MODEL)
+    sim = ChurnSimulation(MODEL, START, END, 30, 5432, engine, **options)
+    sim.chunk_size = 10
+    sim.run_simulation("customer")
+    with engine.connect() as connection:
+        rows = {"account": connection.exec_driver_sql("SELECT * FROM account ORDER BY id").fetchall()}
+        for table in ("subscription", "event"):
+            columns = [row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})") if row[1] != "id"]
+            rows[table] = sorted(connection.exec_driver_sql(f"SELECT {', '.join(columns)} FROM {table}").fetchall())
+        ids = {table: connection.exec_driver_sql(f"SELECT count(DISTINCT id) FROM {table}").scalar()
+               for table in ("account", "subscription", "event")}
+    engine.dispose()
+    return rows, ids
+
+
+def test_sharded_runs(tmp_path):
+    direct, direct_ids = run_customers(tmp_path / "direct.db")
+    assert direct_ids == {table: len(rows) for table, rows in direct.items()}
+    for merge in ("copy", "views"):
+        database = tmp_path / f"{merge}.db"
+        sharded, ids = run_customers(database, shards=2, shard_merge=merge)
+        assert sharded == direct, merge
+        # the ids of the shards are shifted into disjoint ranges
+        assert ids == direct_ids, merge
+        # the copied shards are removed, the views read them
+        assert os.path.exists(f"{database}.shard0") == (merge == "views")
+
+
+def test_too_many_shard_views(tmp_path):
+    # every connection attaches all shards, SQLite allows 10 attached databases
+    engine = create_engine(f"sqlite:///{tmp_path / 'views.db'}")
+    with pytest.raises(ValueError):
+        ChurnSimulation(MODEL, START, END, 30, 5432, engine, shards=11, shard_merge="views")
+    ChurnSimulation(MODEL, START, END, 30, 5432, engine, shards=11, shard_merge="copy")
@@ -0,0 +1,59 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from churnmodels.simulation.sweep import KpiCollector, mean_kpis, parameter_grid, sweep
+from churnmodels.simulation.writer import SimulatedCohort
+
+MODEL = "biznet1"
+START, END = date(2020, 1, 1), date(2020, 6, 1)
+
+
+def step(account_index, mrr, end_date="2020-03-01"):
+    # the subscriptions of a step, the collector does not look at accounts and events
+    subscriptions = {'account_index': np.array(account_index), 'mrr': np.array(mrr, dtype=float),
+                     'end_date': np.full(len(account_index), np.datetime64(end_date, 'D'))}
+    return SimulatedCohort({}, subscriptions, {})
+
+
+def test_kpis():
+    # account 1 churns, account 0 upgrades, account 2 stays, account 3 is new
+    collector = KpiCollector(START, END)
+    collector.put(step([0, 1, 2], [10, 20, 30]))
+    collector.put(step([0, 2, 3], [15, 30, 10]))
+    first = collector.result().iloc[0]
+    assert first.name == START
+    assert first['subscribers'] == 3 and first['mrr'] == 60
+    assert first['churn_rate'] == pytest.approx(1 / 3)
+    assert first['mrr_churn_rate'] == pytest.approx(1 - 40 / 60)
+    assert first['net_retention'] == pytest.approx(45 / 60)
+    assert first['upgrade_rate'] == 0.5 and first['downgrade_rate'] == 0
+
+
+def test_sweep():
+    scenarios = parameter_grid(monthly_growth_rate=[0.0, 0.3], seed=[7])
+    kpis = sweep(scenarios, MODEL, START, END, 100, 42)
+    assert list(kpis['monthly_growth_rate']) == [0.0, 0.3]
+    assert kpis.loc[1, 'subscribers'] > kpis.loc[0, 'subscribers']
+    # the result does not depend on the number of worker processes
+    pd.testing.assert_frame_equal(sweep(scenarios, MODEL, START, END, 100, 42, workers=2), kpis)
+    monthly = sweep(scenarios, MODEL, START, END, 100, 42, monthly=True)
+    for scenario in range(len(scenarios)):
+        means = mean_kpis(monthly.loc[scenario].drop(columns=list(scenarios[0])))
+        pd.testing.assert_series_equal(means, kpis.loc[scenario, means.index], check_names=False)
+
+
+def test_unknown_parameters():
+    with pytest.raises(ValueError):
+        sweep([{'growth': 0.1}], MODEL, START, END, 10, 42)
+    with pytest.raises(ValueError):
+        sweep([{'offset': 0.0, 'target_churn_rate': 0.05}], MODEL, START, END, 10, 42)
+
+
+@pytest.mark.parametrize("target", [0.03, 0.1])
+def test_calibrate_churn(target):
+    # the churn rate of a run with another seed than the calibration runs is the target up to the sampling noise
+    kpis = sweep([{'target_churn_rate': target}], MODEL, START, date(2021, 1, 1), 500, 42)
+    assert kpis.loc[0, 'churn_rate'] == pytest.approx(target, abs=0.01)
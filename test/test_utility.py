@@ -0,0 +1,62 @@
+from datetime import date
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from churnmodels.simulation.churnsim2 import ChurnSimulation
+
+MODEL = "biznet1"
+START, END = date(2020, 1, 1), date(2020, 3, 1)
+
+
+@pytest.fixture
+def model():
+    return ChurnSimulation(MODEL, START, END, 10, 1, None).util_mod
+
+
+def behaviors(model, n, seed=7):
+    '''
+    Event counts around the behavior means (some of them zero) and satisfactions on both sides of 1.
+    '''
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(model.behave_means[0] * rng.uniform(0.0, 2.0, size=(n, 1))).astype(float)
+    satisfaction = rng.uniform(0.5, 2.0, size=n)
+    return counts, satisfaction
+
+
+def test_utility_batch(model):
+    counts, satisfaction = behaviors(model, 200)
+    utility = model.utility_batch(counts, satisfaction)
+    scalar = [model.utility_function(counts[i], SimpleNamespace(satisfaction_propensity=satisfaction[i]))
+              for i in range(len(counts))]
+    np.testing.assert_allclose(utility, scalar)
+    assert (utility > 0).any() and (utility < 0).any()
+
+
+def test_churn_batch(model):
+    counts, satisfaction = behaviors(model, 200)
+    churned = model.churn_batch(counts, satisfaction, np.random.default_rng(3))
+    # the batch uses one uniform draw per row, in row order
+    rng = np.random.default_rng(3)
+    scalar = [model.simulate_churn(counts[i], SimpleNamespace(satisfaction_propensity=satisfaction[i]), rng).item()
+              for i in range(len(counts))]
+    np.testing.assert_array_equal(churned, scalar)
+
+
+@pytest.mark.parametrize("offset", [-20.0, 0.5, 20.0])
+def test_upgrade_downgrade_batch(model, offset):
+    # a low offset makes upgrades almost certain, a high one downgrades
+    model.offset = offset
+    top_plan = len(model.plan_mrr) - 1
+    counts, satisfaction = behaviors(model, 300)
+    plan = np.arange(300) % len(model.plan_mrr)
+    new_plan = model.upgrade_downgrade_batch(counts, satisfaction, plan, np.random.default_rng(5))
+    assert ((new_plan >= 0) & (new_plan <= top_plan)).all()
+    assert (np.abs(new_plan - plan) <= 1).all()
+    assert (plan[new_plan > plan] < top_plan).all()
+    assert (plan[new_plan < plan] == top_plan).all()
+    if offset < -10:
+        assert (new_plan[plan < top_plan] == plan[plan < top_plan] + 1).all()
+    elif offset > 10:
+        assert (new_plan[plan == top_plan] == top_plan - 1).all()
@@ -0,0 +1,244 @@
+import struct
+import threading
+from contextlib import nullcontext
+from datetime import date, datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+
+from churnmodels.schema import create_tables, ensure_indexes, Account, Subscription, Event, EventDaily
+from churnmodels.simulation.writer import SimulatedCohort, CohortWriter, bulk_load, next_ids, reserve_ids, reset_ids, \
+    _binary_copy_buffer, _binary_copy_types
+
+OPTIONS = {"schema": None, "product": "basic", "bill_period_months": 1}
+
+
+def seconds(timestamp):
+    return np.array(timestamp, dtype='datetime64[s]').astype(np.int64)
+
+
+def cohorts(daily=False):
+    '''
+    Two months of a run: the accounts 0 and 1 sign up in January, account 2 in February when account 0 renews.
+    '''
+    january = SimulatedCohort(
+        {'channel': np.array(['web', 'appstore'], dtype=object),
+         'date_of_birth': np.array(['1990-05-01', '1985-12-31'], dtype='datetime64[D]'),
+         'country': np.array(['DE', 'US'], dtype=object)},
+        {'account_index': np.array([0, 1]),
+         'start_date': np.array(['2020-01-03', '2020-01-10'], dtype='datetime64[D]'),
+         'end_date': np.array(['2020-02-03', '2020-02-10'], dtype='datetime64[D]'),
+         'mrr': np.array([10.0, 20.0])},
+        {'account_index': np.array([0, 1]),
+         'event_time': seconds(['2020-01-05T10:30:00', '2020-01-11T00:00:01']),
+         'event_type': np.array([0, 2], dtype=np.int16)})
+    february = SimulatedCohort(
+        {'channel': np.array(['web'], dtype=object),
+         'date_of_birth': np.array(['2001-02-03'], dtype='datetime64[D]'),
+         'country': np.array(['FR'], dtype=object)},
+        {'account_index': np.array([0, 2]),
+         'start_date': np.array(['2020-02-03', '2020-02-05'], dtype='datetime64[D]'),
+         'end_date': np.array(['2020-03-03', '2020-03-05'], dtype='datetime64[D]'),
+         'mrr': np.array([15.0, 10.0])},
+        {'account_index': np.array([2, 0]),
+         'event_time': seconds(['2020-02-06T08:00:00', '2020-02-07T23:59:59']),
+         'event_type': np.array([1, 0], dtype=np.int16)},
+        account_base=2)
+    if daily:
+        for cohort in (january, february):
+            cohort.events['event_time'] -= cohort.events['event_time'] % 86400
+            cohort.events['n'] = np.array([3, 1])
+    return january, february
+
+
+def written_rows(engine, *tables):
+    with engine.connect() as connection:
+        return [connection.execute(select(table.__table__).order_by(table.id)).fetchall() for table in tables]
+
+
+@pytest.mark.parametrize("database", ["file", "memory"])
+def test_write_cohorts(tmp_path, database):
+    # a file database is written by the writer thread, an in-memory one by the caller
+    engine = create_engine(f"sqlite:///{tmp_path / 'sim.db'}" if database == "file" else "sqlite://")
+    create_tables(engine)
+    with engine.begin() as connection:
+        # an account written before the id_sequence rows existed, the ids continue after it
+        connection.execute(Account.__table__.insert().values(id=7, channel="web", date_of_birth=date(1970, 1, 1)))
+    with CohortWriter(engine, OPTIONS) as writer:
+        assert writer.threaded == (database == "file")
+        for cohort in cohorts():
+            writer.put(cohort)
+
+    accounts, subscriptions, events = written_rows(engine, Account, Subscription, Event)
+    assert [tuple(row) for row in accounts[1:]] == [(8, 'web', date(1990, 5, 1), 'DE'),
+                                                     (9, 'appstore', date(1985, 12, 31), 'US'),
+                                                     (10, 'web', date(2001, 2, 3), 'FR')]
+    assert [(row.id, row.account_id, row.product, row.start_date, row.mrr, row.bill_period_months)
+            for row in subscriptions] == [(1, 8, 'basic', date(2020, 1, 3), 10.0, 1),
+                                          (2, 9, 'basic', date(2020, 1, 10), 20.0, 1),
+                                          (3, 8, 'basic', date(2020, 2, 3), 15.0, 1),
+                                          (4, 10, 'basic', date(2020, 2, 5), 10.0, 1)]
+    assert [tuple(row) for row in events] == [(1, 8, datetime(2020, 1, 5, 10, 30), 1),
+                                              (2, 9, datetime(2020, 1, 11, 0, 0, 1), 3),
+                                              (3, 10, datetime(2020, 2, 6, 8), 2),
+                                              (4, 8, datetime(2020, 2, 7, 23, 59, 59), 1)]
+
+
+def test_daily_events():
+    engine = create_engine("sqlite://")
+    create_tables(engine)
+    with CohortWriter(engine, OPTIONS) as writer:
+        for cohort in cohorts(daily=True):
+            writer.put(cohort)
+    events, daily = written_rows(engine, Event, EventDaily)
+    assert events == []
+    assert [tuple(row) for row in daily] == [(1, 1, date(2020, 1, 5), 1, 3), (2, 2, date(2020, 1, 11), 3, 1),
+                                             (3, 3, date(2020, 2, 6), 2, 3), (4, 1, date(2020, 2, 7), 1, 1)]
+
+
+def test_failed_write(tmp_path):
+    # the error of the writer thread is raised in the caller
+    engine = create_engine(f"sqlite:///{tmp_path / 'no_tables.db'}")
+    with pytest.raises(OperationalError):
+        with CohortWriter(engine, OPTIONS) as writer:
+            for cohort in cohorts():
+                writer.put(cohort)
+
+
+def test_reserve_ids(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ids.db'}")
+    create_tables(engine)
+    with engine.begin() as connection:
+        # rows written before the id_sequence rows existed, the ids continue after them
+        connection.execute(Account.__table__.insert().values(id=7, channel="web", date_of_birth=date(1970, 1, 1)))
+        connection.execute(Subscription.__table__.insert().values(
+            id=41, account_id=7, product="basic", start_date=date(2020, 1, 1), mrr=10.0, bill_period_months=1))
+    assert next_ids(engine) == (8, 42, 1, 1)
+    assert reserve_ids(engine, (3, 2, 1, 0)) == (8, 42, 1, 1)
+    assert reserve_ids(engine, (1, 0, 5, 2)) == (11, 44, 2, 1)
+    assert next_ids(engine) == (12, 44, 7, 3)
+    # the next ids are set, also below the ids handed out
+    with engine.begin() as connection:
+        reset_ids(connection, (5, 6, 7, 8))
+    assert next_ids(engine) == (5, 6, 7, 8)
+    assert reserve_ids(engine, (1, 1, 1, 1)) == (5, 6, 7, 8)
+
+
+def test_concurrent_reserve_ids(tmp_path):
+    # threads reserving at the same time get disjoint ranges without gaps
+    engine = create_engine(f"sqlite:///{tmp_path / 'ids.db'}", connect_args={"timeout": 30})
+    create_tables(engine)
+    counts = [(3, 2, 1, 0), (1, 4, 0, 2)]
+    reserved = []
+
+    def reserve(k):
+        for _ in range(5):
+            reserved.append((counts[k % 2], reserve_ids(engine, counts[k % 2])))
+
+    threads = [threading.Thread(target=reserve, args=(k,)) for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(reserved) == 40
+    for table in range(4):
+        ranges = sorted((first_ids[table], n[table]) for n, first_ids in reserved if n[table] > 0)
+        ids = np.concatenate([np.arange(first, first + n) for first, n in ranges])
+        np.testing.assert_array_equal(ids, np.arange(1, len(ids) + 1))
+        assert next_ids(engine)[table] == len(ids) + 1
+
+
+def index_names(engine):
+    with engine.connect() as connection:
+        return {row[0] for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+
+
+def test_bulk_load_indexes(tmp_path):
+    # the churn indexes of the loaded tables are dropped for the load and built when it is done
+    engine = create_engine(f"sqlite:///{tmp_path / 'sim.db'}")
+    create_tables(engine)
+    ensure_indexes(engine, tables=["event", "metric"])
+    with bulk_load(engine, indexes=True):
+        assert index_names(engine) == {"ix_metric_account_time_name"}
+        with CohortWriter(engine, OPTIONS) as writer:
+            for cohort in cohorts():
+                writer.put(cohort)
+    assert index_names(engine) == {"ix_metric_account_time_name", "ix_event_time_account_type",
+                                   "ix_event_daily_day_account_type", "ix_subscription_account_dates"}
+    assert len(written_rows(engine, Event)[0]) == 4
+
+
+def pragmas(engine):
+    with engine.connect() as connection:
+        return tuple(connection.exec_driver_sql(f"PRAGMA {name}").scalar() for name in ("journal_mode", "synchronous"))
+
+
+@pytest.mark.parametrize("journal_mode", ["OFF", "WAL"])
+def test_bulk_load_settings(tmp_path, journal_mode):
+    # the settings and indexes are restored when the block is left, also by an error
+    engine = create_engine(f"sqlite:///{tmp_path / 'sim.db'}")
+    create_tables(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE INDEX ix_account_country ON account (country)")
+    ensure_indexes(engine, tables=["event"])
+    before = pragmas(engine)
+    assert before == ("delete", 2)
+    for fail in (False, True):
+        with pytest.raises(RuntimeError) if fail else nullcontext():
+            with bulk_load(engine, tables=("account", "event"), journal_mode=journal_mode):
+                assert pragmas(engine) == (journal_mode.lower(), 0)
+                assert index_names(engine) == set()
+                if fail:
+                    raise RuntimeError("load failed")
+        assert pragmas(engine) == before
+        assert index_names(engine) == {"ix_account_country", "ix_event_time_account_type"}
+
+
+class ColumnTypes:
+    '''
+    Stands in for the psycopg2 cursor _binary_copy_types reads the column types of the table with.
+    '''
+    def __init__(self, db_types):
+        self.db_types = db_types
+
+    def execute(self, sql, parameters):
+        pass
+
+    def fetchall(self):
+        return list(self.db_types.items())
+
+
+COPY_TYPES = {'id': 'bigint', 'mrr': 'double precision', 'start_date': 'date',
+              'event_time': 'timestamp without time zone', 'event_type_id': 'integer', 'product': 'text'}
+
+
+def test_binary_copy_buffer():
+    columns = {'id': np.array([1, 2]), 'mrr': np.array([1.5, -2.0]),
+               'start_date': np.array(['2000-01-02', '1999-12-31'], dtype='datetime64[D]'),
+               'event_time': np.array(['2000-01-01T00:00:01', 'NaT'], dtype='datetime64[s]')}
+    types = _binary_copy_types(ColumnTypes(COPY_TYPES), 'event', None, columns)
+    assert types == {'id': ('bigint', '>i8'), 'mrr': ('double precision', '>f8'), 'start_date': ('date', '>i4'),
+                     'event_time': ('timestamp without time zone', '>i8')}
+    # field count, then length and value of every field, days and microseconds since 2000-01-01, NULL has length -1
+    expected = (b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+                + struct.pack('>h iq id ii iq', 4, 8, 1, 8, 1.5, 4, 1, 8, 1000000)
+                + struct.pack('>h iq id ii i', 4, 8, 2, 8, -2.0, 4, -1, -1)
+                + b'\xff\xff')
+    assert _binary_copy_buffer(columns, types) == expected
+    assert _binary_copy_buffer({'id': np.array([], dtype=np.int64)}, {'id': ('bigint', '>i8')}) == \
+        expected[:19] + b'\xff\xff'
+
+
+@pytest.mark.parametrize("name, values", [
+    ('product', np.array(['basic'], dtype=object)),  # text column
+    ('event_type_id', np.array([2 ** 31])),  # out of the integer range
+    ('id', np.array([1.5])),  # float into an integer column
+    ('start_date', np.array([1])),  # not a date
+    ('unknown', np.array([1])),  # not a column of the table
+])
+def test_csv_copy_fallback(name, values):
+    columns = {'id': np.array([1]), name: values}
+    assert _binary_copy_types(ColumnTypes(COPY_TYPES), 'event', None, columns) is None